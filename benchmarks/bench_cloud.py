@@ -0,0 +1,183 @@
+"""
+End-to-end benchmarks of EphEmber against a local fake cloud
+(see benchmarks/fakecloud.py): getter and setter latency, connection
+reuse, and throughput of the zone helpers and pointData codec.
+
+Results are printed as JSON; latencies are in milliseconds.
+
+Run from the repository root: python -m benchmarks.bench_cloud
+"""
+import argparse
+import json
+import statistics
+import time
+import timeit
+
+from pyephember.pyephember import (
+    Zone, ZoneCommand, point_data_to_values, zone_commands_to_b64,
+    zone_current_temperature, zone_is_active, zone_target_temperature
+)
+
+from .fakecloud import FakeCloud
+
+
+def latencies(func, iterations):
+    """
+    Call func iterations times, returning latency statistics
+    """
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append(1000 * (time.perf_counter() - start))
+    samples.sort()
+    return {
+        'median_ms': statistics.median(samples),
+        'p95_ms': samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        'max_ms': samples[-1],
+    }
+
+
+def bench_getters(cloud, iterations):
+    """
+    Latency of a whole home fetch, and of get_zone_temperature with and
+    without the home cache and from live MQTT state
+    """
+    ember = cloud.client()
+    results = {'whole_home': latencies(ember.get_zones, iterations)}
+    ember.close()
+    for label, kwargs in (('uncached', {}), ('cached', {'cache_home': True})):
+        ember = cloud.client(**kwargs)
+        name = ember.get_zone_names()[-1]
+        results[label] = latencies(
+            lambda: ember.get_zone_temperature(name), iterations
+        )
+        ember.close()
+
+    ember = cloud.client()
+    name = ember.get_zone_names()[-1]
+    ember.start_live_updates()
+    results['live'] = latencies(
+        lambda: ember.get_zone_temperature(name), iterations
+    )
+    ember.stop_live_updates()
+    ember.close()
+    return results
+
+
+def bench_setters(cloud, iterations):
+    """
+    Latency of set_zone_target_temperature, published on a connection
+    per command, on a persistent connection, and confirmed by the zone.
+    Each call also looks the zone up again, since a command invalidates
+    the home cache.
+    """
+    results = {}
+    cases = (
+        ('connect_per_command', {}, False),
+        ('persistent', {'persistent_mqtt': True}, False),
+        ('confirmed', {'persistent_mqtt': True}, True),
+    )
+    for label, kwargs, wait in cases:
+        ember = cloud.client(cache_home=True, **kwargs)
+        name = ember.get_zone_names()[0]
+        targets = iter(range(iterations))
+
+        def set_target(ember=ember, name=name, targets=targets, wait=wait):
+            target = 15 + next(targets) % 10
+            if not ember.set_zone_target_temperature(name, target, wait=wait):
+                raise RuntimeError("Command not confirmed")
+
+        results[label] = latencies(set_target, iterations)
+        ember.close()
+    return results
+
+
+def bench_connections(cloud, iterations):
+    """
+    Connections opened by the server side for iterations getter and
+    setter calls
+    """
+    before = cloud.stats()
+    ember = cloud.client(persistent_mqtt=True)
+    name = ember.get_zone_names()[0]
+    for number in range(iterations):
+        ember.get_zone_temperature(name)
+        ember.set_zone_target_temperature(name, 15 + number % 10)
+    ember.close()
+    after = cloud.stats()
+    return {
+        key: after[key] - before[key] for key in after
+    }
+
+
+def bench_codec(cloud, repeat):
+    """
+    Calls per second of the zone helpers and pointData codec
+    """
+    ember = cloud.client()
+    zone_dicts = ember.get_zones()
+    ember.close()
+    commands = [ZoneCommand('TARGET_TEMP', 21), ZoneCommand('MODE', 1)]
+    pstr = zone_commands_to_b64(
+        commands + [ZoneCommand('BOOST_TIME', 1700000000)]
+    )
+
+    def helpers_on_dicts():
+        for zone in zone_dicts:
+            zone_current_temperature(zone)
+            zone_target_temperature(zone)
+            zone_is_active(zone)
+
+    parsed = [Zone(zone) for zone in zone_dicts]
+
+    def helpers_on_zones():
+        for zone in parsed:
+            zone_current_temperature(zone)
+            zone_target_temperature(zone)
+            zone_is_active(zone)
+
+    cases = {
+        'zone_helpers_dict': (helpers_on_dicts, 3 * len(zone_dicts)),
+        'zone_helpers_zone': (helpers_on_zones, 3 * len(zone_dicts)),
+        'zone_parse': (lambda: [Zone(zone) for zone in zone_dicts],
+                       len(zone_dicts)),
+        'encode_commands': (lambda: zone_commands_to_b64(commands), 1),
+        'decode_point_data': (lambda: point_data_to_values(pstr), 1),
+    }
+    results = {}
+    for label, (func, calls) in cases.items():
+        number = max(1, 20000 // calls)
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        results[label + '_per_s'] = number * calls / best
+    return results
+
+
+def main():
+    """
+    Run the benchmarks and print results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--zones', type=int, default=8,
+                        help="Number of zones in the fake home")
+    parser.add_argument('--iterations', type=int, default=50,
+                        help="Calls per latency measurement")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Runs per throughput measurement, "
+                             "the best is reported")
+    args = parser.parse_args()
+
+    with FakeCloud(zones=args.zones) as cloud:
+        results = {
+            'zones': args.zones,
+            'iterations': args.iterations,
+            'getters': bench_getters(cloud, args.iterations),
+            'setters': bench_setters(cloud, args.iterations),
+            'connections': bench_connections(cloud, args.iterations),
+            'codec': bench_codec(cloud, args.repeat),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Benchmark decoding of MQTT pointData: the byte-at-a-time decoder that
+messagelogger.py used against the library codec, single and batched.
+
+Run from the repository root: python -m benchmarks.bench_codec
+"""
+import argparse
+import base64
+import json
+import random
+import timeit
+
+from pyephember.pyephember import (
+    POINT_TYPE_LENGTHS, encode_point_data, point_data_to_values,
+    point_data_to_values_batch
+)
+
+
+def legacy_decode(pstr):
+    """
+    State machine decoder as formerly in messagelogger.py,
+    without the PointIndex name lookup
+    """
+    parsed = {}
+    mode = "wait"
+    datatype = None
+    index = None
+    value = []
+    for number in base64.b64decode(pstr):
+        if mode == "wait":
+            mode = "index"
+        elif mode == "index":
+            index = number
+            mode = "datatype"
+        elif mode == "datatype":
+            datatype = number
+            mode = "value"
+        else:
+            value.append(number)
+            if len(value) == POINT_TYPE_LENGTHS[datatype]:
+                result = 0
+                for a_byte in value:
+                    result = result * 256 + a_byte
+                parsed[index] = result
+                value = []
+                mode = "wait"
+    return parsed
+
+
+def synthetic_pushes(count, distinct):
+    """
+    count base64 pointData strings drawn from distinct random messages
+    """
+    rng = random.Random(0)
+    messages = []
+    for _ in range(distinct):
+        records = [
+            (index, point_type,
+             rng.randrange(256 ** POINT_TYPE_LENGTHS[point_type]))
+            for index, point_type in rng.sample(
+                [(4, 1), (5, 2), (6, 4), (7, 1), (8, 1), (9, 5), (10, 1)],
+                rng.randint(1, 4)
+            )
+        ]
+        messages.append(
+            base64.b64encode(encode_point_data(records)).decode("ascii")
+        )
+    return [rng.choice(messages) for _ in range(count)]
+
+
+def main():
+    """
+    Run the benchmark and print results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--distinct', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    pushes = synthetic_pushes(args.messages, args.distinct)
+
+    def best(func):
+        return min(timeit.repeat(func, number=1, repeat=args.repeat))
+
+    results = {
+        'legacy': best(lambda: [legacy_decode(p) for p in pushes]),
+        'codec': best(lambda: [point_data_to_values(p) for p in pushes]),
+        'codec_batch': best(lambda: point_data_to_values_batch(pushes)),
+    }
+    print(json.dumps({
+        'messages': args.messages,
+        'messages_per_second': {
+            name: args.messages / seconds
+            for name, seconds in results.items()
+        }
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
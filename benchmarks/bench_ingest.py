@@ -0,0 +1,96 @@
+"""
+Benchmark ingest of raw upload/pointdata payloads: decoding on the
+calling thread, as a paho on_message callback does, against the
+IngestPipeline with increasing numbers of worker processes.
+
+Run from the repository root: python -m benchmarks.bench_ingest
+"""
+import argparse
+import json
+import os
+import time
+
+from pyephember.ingest import IngestPipeline
+from pyephember.pyephember import _pointdata_message_values
+
+from .bench_codec import synthetic_pushes
+
+
+def synthetic_payloads(count, zones):
+    """
+    count raw MQTT payloads spread over zones zone MACs
+    """
+    pushes = synthetic_pushes(count, 500)
+    return [
+        json.dumps({
+            'common': {'serial': 7870, 'productId': 'productid135',
+                       'uid': 'uid011',
+                       'timestamp': str(1700000000000 + number)},
+            'data': {'mac': 'mac{:04d}'.format(number % zones),
+                     'pointData': pstr}
+        }).encode('utf-8') + b'\0'
+        for number, pstr in enumerate(pushes)
+    ]
+
+
+def inline(payloads):
+    """
+    Messages per second decoding each payload on this thread
+    """
+    state = {}
+    start = time.perf_counter()
+    for payload in payloads:
+        mac, values = _pointdata_message_values(payload)
+        state.setdefault(mac, {}).update(values)
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def pipeline(payloads, workers, batch_size):
+    """
+    Stats of an IngestPipeline run over the payloads
+    """
+    state = {}
+
+    def on_pointdata(mac, values):
+        state.setdefault(mac, {}).update(values)
+
+    ingest = IngestPipeline(
+        on_pointdata, workers=workers, batch_size=batch_size
+    ).start()
+    for payload in payloads:
+        ingest.submit(payload)
+    ingest.stop()
+    return ingest.stats()
+
+
+def main():
+    """
+    Run the benchmark and print results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--zones', type=int, default=256)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--max-workers', type=int,
+                        default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    payloads = synthetic_payloads(args.messages, args.zones)
+    results = {'inline_per_s': inline(payloads), 'pipeline': {}}
+    workers = 1
+    while workers <= args.max_workers:
+        stats = pipeline(payloads, workers, args.batch_size)
+        results['pipeline'][workers] = {
+            key: stats[key] for key in (
+                'submit_per_s', 'decode_per_s', 'deliver_per_s',
+                'worker_decode_per_s', 'backpressure_s', 'errors'
+            )
+        }
+        workers *= 2
+    print(json.dumps({
+        'messages': args.messages, 'zones': args.zones, **results
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Benchmark the per-command cost of encoding zone commands into
+MQTT messages, before and after the publish context was added.
+
+No network is used: the home details are served from memory, as they
+are once EphEmber has fetched them.
+
+Run from the repository root: python -m benchmarks.bench_publish
+"""
+import argparse
+import base64
+import json
+import time
+import timeit
+
+from pyephember.pyephember import (
+    EphMessenger, ZoneCommand, zone_command_to_ints, zone_commands_to_b64
+)
+
+
+class _Parent:
+    """
+    Stand-in for EphEmber with memoized home details
+    """
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self):
+        self._home_details = {
+            'homes': {'productId': 'productid135', 'uid': 'uid011'}
+        }
+
+    def get_home_details(self):
+        """
+        Memoized home details, as EphEmber returns them
+        """
+        return self._home_details
+
+
+def legacy_encode(parent, mac, commands):
+    """
+    Topic and message as built per command before the publish context
+    """
+    product_id = parent.get_home_details()['homes']['productId']
+    uid = parent.get_home_details()['homes']['uid']
+    ints_cmd = [x for cmd in commands for x in zone_command_to_ints(cmd)]
+    msg = json.dumps(
+        {
+            "common": {
+                "serial": 7870,
+                "productId": product_id,
+                "uid": uid,
+                "timestamp": str(int(1000*time.time()))
+            },
+            "data": {
+                "mac": mac,
+                "pointData": base64.b64encode(bytes(ints_cmd)).decode("ascii")
+            }
+        }
+    )
+    topic = "/".join([product_id, uid, "download/pointdata"])
+    return topic, msg
+
+
+def context_encode(messenger, mac, commands):
+    """
+    Topic and message using the cached publish context
+    """
+    # pylint: disable=protected-access
+    context = messenger._publish_context()
+    return (
+        context.download_topic,
+        context.message(mac, zone_commands_to_b64(commands))
+    )
+
+
+def main():
+    """
+    Run the benchmark and print results as JSON
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--commands', type=int, default=10000,
+                        help="Number of commands per run")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="Number of runs, the best is reported")
+    args = parser.parse_args()
+
+    parent = _Parent()
+    messenger = EphMessenger(parent)
+    work = [
+        ("mac{:04d}".format(i % 64),
+         [ZoneCommand('TARGET_TEMP', 15 + i % 10), ZoneCommand('MODE', i % 4)])
+        for i in range(args.commands)
+    ]
+
+    def run(encode, target):
+        def bulk():
+            for mac, commands in work:
+                encode(target, mac, commands)
+        return min(timeit.repeat(bulk, number=1, repeat=args.repeat))
+
+    legacy = run(legacy_encode, parent)
+    context = run(context_encode, messenger)
+    print(json.dumps({
+        'commands': args.commands,
+        'legacy_us_per_command': 1e6 * legacy / args.commands,
+        'context_us_per_command': 1e6 * context / args.commands,
+        'speedup': legacy / context
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,463 @@
+"""
+A local stand-in for the Ember cloud, for benchmarks and tests: an HTTP
+server for the appLogin/*, homes/*, user/* and homesVT/* endpoints and
+a minimal MQTT 3.1.1 broker, both serving synthetic homes of N zones.
+
+Zones answer commands like the real devices do: a message published to
+the download/pointdata topic updates the zone and is echoed back on the
+upload/pointdata topic after echo_delay seconds. Errors can be injected
+with fail(), and requests_to() counts the requests of an endpoint.
+
+Example usage: with FakeCloud(zones=8) as cloud:
+                   ember = cloud.client()
+                   ember.get_zone_names()
+"""
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import binascii
+import collections
+import json
+import struct
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pyephember.pyephember import EphEmber, decode_point_data
+
+PRODUCT_ID = 'productid135'
+
+# point index -> initial value of every synthetic zone
+_INITIAL_POINTS = {
+    4: 0, 5: 195, 6: 200, 7: 0, 8: 0, 9: 0, 10: 1, 14: 220,
+    15: 0xabab, 16: 0, 17: 0xabab, 18: 0x0ab7,
+}
+
+
+def synthetic_zone(number, home=0):
+    """
+    Zone dict, as returned by homesVT/zoneProgram, of zone number
+    of home number home
+    """
+    period = {'startTime': 70, 'endTime': 90}
+    return {
+        'zoneid': 'zoneid{:03d}{:04d}'.format(home, number),
+        'name': 'Zone {}'.format(number),
+        'mac': 'mac{:03d}{:04d}'.format(home, number),
+        'deviceDays': [
+            {'dayType': day, 'p1': period,
+             'p2': {'startTime': 120, 'endTime': 130},
+             'p3': {'startTime': 170, 'endTime': 220}}
+            for day in range(7)
+        ],
+        'pointDataList': [
+            {'pointIndex': index, 'value': str(value)}
+            for index, value in _INITIAL_POINTS.items()
+        ],
+    }
+
+
+class _Home:
+    """
+    Zone state of a home, shared by the HTTP server and the broker
+    """
+
+    def __init__(self, zones, number=0):
+        self.gateway_id = 'gateway{:03d}'.format(number)
+        self.uid = 'uid{:03d}'.format(number)
+        self.zones = [
+            synthetic_zone(zone, number) for zone in range(zones)
+        ]
+        self.by_mac = {zone['mac']: zone for zone in self.zones}
+        self.lock = threading.Lock()
+
+    def details(self):
+        """
+        homes/detail data of the home
+        """
+        return {'homes': {
+            'productId': PRODUCT_ID, 'uid': self.uid,
+            'gatewayid': self.gateway_id
+        }}
+
+    def snapshot(self):
+        """
+        JSON text of the homesVT/zoneProgram data
+        """
+        with self.lock:
+            return json.dumps(self.zones)
+
+    def zone(self, zone_id):
+        """
+        JSON text of the zone with zone_id, or None
+        """
+        with self.lock:
+            for zone in self.zones:
+                if zone['zoneid'] == zone_id:
+                    return json.dumps(zone)
+        return None
+
+    def apply(self, mac, values):
+        """
+        Write point values to a zone, returning False for unknown zones
+        """
+        with self.lock:
+            zone = self.by_mac.get(mac)
+            if zone is None:
+                return False
+            points = {
+                datum['pointIndex']: datum for datum in zone['pointDataList']
+            }
+            for index, value in values.items():
+                if index in points:
+                    points[index]['value'] = str(value)
+                else:
+                    zone['pointDataList'].append(
+                        {'pointIndex': index, 'value': str(value)}
+                    )
+            return True
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    """
+    Serves the cloud HTTP API from the homes of the server
+    """
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def _reply(self, endpoint, request):
+        # pylint: disable=too-many-return-statements
+        request = json.loads(request or '{}')
+        home = self.server.homes.get(request.get('gateWayId'))
+        if endpoint == 'appLogin/login':
+            return {'status': 0, 'data': {
+                'token': 'token', 'refresh_token': 'refresh'
+            }}
+        if endpoint == 'appLogin/refreshAccessToken':
+            return {'status': 0, 'data': {
+                'token': 'token', 'refresh_token': 'refresh'
+            }}
+        if endpoint == 'homes/list':
+            return {'status': 0, 'data': [
+                {'gatewayid': gateway_id} for gateway_id in self.server.homes
+            ]}
+        if endpoint == 'user/selectUser':
+            return {'status': 0, 'data': {'id': 1}}
+        if endpoint == 'homesVT/zoneViewProgram':
+            zone = None
+            for other in self.server.homes.values():
+                zone = zone or other.zone(request.get('zoneid'))
+            if zone is None:
+                return {'status': 1, 'message': 'no zone'}
+            return '{{"status": 0, "timestamp": {}, "data": {}}}'.format(
+                int(1000*time.time()), zone
+            )
+        if home is None:
+            return {'status': 1, 'message': 'no home'}
+        if endpoint == 'homes/detail':
+            return {'status': 0, 'data': home.details()}
+        if endpoint == 'homesVT/zoneProgram':
+            return '{{"status": 0, "timestamp": {}, "data": {}}}'.format(
+                int(1000*time.time()), home.snapshot()
+            )
+        return None
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        request = self.rfile.read(length)
+        endpoint = self.path.split('/ember-back/', 1)[-1]
+        with self.server.stats_lock:
+            self.server.requests += 1
+            self.server.endpoints[endpoint] += 1
+            self.server.connections.add(self.client_address)
+            faults = self.server.faults.get(endpoint)
+            status = faults.pop(0) if faults else None
+        if status is not None:
+            self.send_error(status)
+            return
+
+        reply = self._reply(endpoint, request)
+        if reply is None:
+            self.send_error(404)
+            return
+        if not isinstance(reply, str):
+            reply = json.dumps(reply)
+        body = reply.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = _handle
+    do_POST = _handle
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+def _remaining_length(length):
+    """
+    MQTT variable length encoding of a packet's remaining length
+    """
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def _publish_packet(topic, payload):
+    """
+    QoS 0 MQTT PUBLISH packet
+    """
+    topic = topic.encode('utf-8')
+    body = struct.pack('>H', len(topic)) + topic + payload
+    return b'\x30' + _remaining_length(len(body)) + body
+
+
+class _Broker:
+    """
+    MQTT 3.1.1 broker with just enough of the protocol for paho:
+    QoS 0 and 1 publishes, exact-match subscriptions, pings.
+    Also plays the zones, see FakeCloud.
+    """
+
+    def __init__(self, homes, echo_delay):
+        # uid -> _Home
+        self.homes = {home.uid: home for home in homes}
+        self.echo_delay = echo_delay
+        self.loop = None
+        self.server = None
+        # topic -> set of StreamWriters
+        self.subscribers = {}
+        self.tasks = set()
+        self.connections = 0
+        self.published = 0
+
+    def _route(self, topic, payload):
+        packet = _publish_packet(topic, payload)
+        for writer in list(self.subscribers.get(topic, ())):
+            writer.write(packet)
+        if topic.endswith('/download/pointdata'):
+            self._command(topic, payload)
+
+    def _command(self, topic, payload):
+        """
+        Apply a zone command and echo it as the zone would
+        """
+        data = json.loads(payload.decode('utf-8')).get('data', {})
+        pstr = data.get('pointData')
+        if pstr is None:
+            return
+        home = self.homes.get(topic.split('/')[1])
+        if home is None or not home.apply(
+                data['mac'], decode_point_data(binascii.a2b_base64(pstr))):
+            return
+        echo = json.dumps({
+            'common': {'productId': PRODUCT_ID, 'uid': home.uid},
+            'data': {'mac': data['mac'], 'pointData': pstr}
+        }).encode('utf-8')
+        upload = topic[:-len('download/pointdata')] + 'upload/pointdata'
+        self.loop.call_later(self.echo_delay, self._route, upload, echo)
+
+    async def _packets(self, reader):
+        while True:
+            header = (await reader.readexactly(1))[0]
+            length = 0
+            shift = 0
+            while True:
+                byte = (await reader.readexactly(1))[0]
+                length |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            yield header, await reader.readexactly(length)
+
+    async def _serve(self, reader, writer):
+        # pylint: disable=too-many-branches
+        self.connections += 1
+        self.tasks.add(asyncio.current_task())
+        topics = set()
+        try:
+            async for header, body in self._packets(reader):
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    writer.write(b'\x20\x02\x00\x00')
+                elif kind == 3:  # PUBLISH
+                    self.published += 1
+                    size = struct.unpack('>H', body[:2])[0]
+                    topic = body[2:2 + size].decode('utf-8')
+                    start = 2 + size
+                    if (header >> 1) & 3:
+                        writer.write(b'\x40\x02' + body[start:start + 2])
+                        start += 2
+                    self._route(topic, body[start:])
+                elif kind in (8, 10):  # SUBSCRIBE, UNSUBSCRIBE
+                    pos = 2
+                    count = 0
+                    while pos < len(body):
+                        size = struct.unpack('>H', body[pos:pos + 2])[0]
+                        topic = body[pos + 2:pos + 2 + size].decode('utf-8')
+                        pos += 2 + size
+                        count += 1
+                        if kind == 8:
+                            pos += 1
+                            topics.add(topic)
+                            self.subscribers.setdefault(
+                                topic, set()
+                            ).add(writer)
+                        else:
+                            topics.discard(topic)
+                            self.subscribers.get(topic, set()).discard(writer)
+                    if kind == 8:
+                        writer.write(
+                            bytes([0x90, 2 + count]) + body[:2]
+                            + bytes(count)
+                        )
+                    else:
+                        writer.write(b'\xb0\x02' + body[:2])
+                elif kind == 12:  # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif kind == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError,
+                asyncio.CancelledError):
+            pass
+        finally:
+            self.tasks.discard(asyncio.current_task())
+            for topic in topics:
+                self.subscribers.get(topic, set()).discard(writer)
+            writer.close()
+
+    def start(self):
+        """
+        Run the broker on its own thread, returning its port
+        """
+        self.loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        async def listen():
+            self.server = await asyncio.start_server(
+                self._serve, '127.0.0.1', 0
+            )
+            ready.set()
+
+        def run():
+            self.loop.run_until_complete(listen())
+            self.loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+        return self.server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        """
+        Stop the broker
+        """
+        async def shutdown():
+            self.server.close()
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class FakeCloud:
+    """
+    Local HTTP API and MQTT broker serving homes of zones,
+    all belonging to every account
+    """
+
+    def __init__(self, zones=8, echo_delay=0.0, homes=1):
+        self.homes = [_Home(zones, number) for number in range(homes)]
+        self.home = self.homes[0]
+        self.broker = _Broker(self.homes, echo_delay)
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), _HTTPHandler)
+        self.http.daemon_threads = True
+        self.http.homes = {home.gateway_id: home for home in self.homes}
+        self.http.requests = 0
+        self.http.endpoints = collections.Counter()
+        # endpoint -> HTTP statuses to answer its next requests with
+        self.http.faults = {}
+        self.http.connections = set()
+        self.http.stats_lock = threading.Lock()
+        self.mqtt_port = None
+
+    @property
+    def http_api_base(self):
+        """
+        Base URL of the HTTP API
+        """
+        return 'http://127.0.0.1:{}/ember-back/'.format(
+            self.http.server_port
+        )
+
+    def stats(self):
+        """
+        Counters of the requests and connections served so far
+        """
+        with self.http.stats_lock:
+            return {
+                'http_requests': self.http.requests,
+                'http_connections': len(self.http.connections),
+                'mqtt_connections': self.broker.connections,
+                'mqtt_publishes': self.broker.published,
+            }
+
+    def requests_to(self, endpoint):
+        """
+        Number of requests to endpoint (e.g. 'homes/list') so far
+        """
+        with self.http.stats_lock:
+            return self.http.endpoints[endpoint]
+
+    def fail(self, endpoint, status, times=1):
+        """
+        Answer the next times requests to endpoint (e.g. 'homes/list')
+        with the HTTP error status
+        """
+        with self.http.stats_lock:
+            self.http.faults.setdefault(endpoint, []).extend(
+                [status] * times
+            )
+
+    def client(self, username='user@example.com', **kwargs):
+        """
+        EphEmber connected to this cloud, kwargs are passed to it
+        """
+        ember = EphEmber(username, 'password', lazy_login=True, **kwargs)
+        ember.http_api_base = self.http_api_base
+        ember.messenger.api_url = '127.0.0.1'
+        ember.messenger.api_port = self.mqtt_port
+        ember.messenger.use_tls = False
+        return ember
+
+    def start(self):
+        """
+        Start serving
+        """
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.mqtt_port = self.broker.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving
+        """
+        self.http.shutdown()
+        self.http.server_close()
+        self.broker.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
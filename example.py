@@ -5,7 +5,6 @@ get the current temperature, and change the target temperature for a zone
 import argparse
 import getpass
 import json
-import time
 
 from pyephember.pyephember import EphEmber
 
@@ -60,11 +59,14 @@ print("{} mode : {}".format(
 target = args.target
 if target is not None:
     assert 0 <= target <= 25.5
-    t.set_zone_target_temperature(args.zone_name, target)
-    time.sleep(1)
-    print("{} target temperature changed to {}".format(
-        args.zone_name, t.get_zone_target_temperature(args.zone_name)
-    ))
+    if t.set_zone_target_temperature(args.zone_name, target, wait=True):
+        print("{} target temperature changed to {}".format(
+            args.zone_name, target
+        ))
+    else:
+        print("{} target temperature change not confirmed".format(
+            args.zone_name
+        ))
 
 if args.advance is not None:
     print("Setting advance for {} to {}".format(args.zone_name, args.advance))
@@ -8,7 +8,11 @@ import argparse
 import getpass
 import time
 
-from pyephember.pyephember import EphEmber, PointIndex
+from pyephember.pyephember import (
+    EphEmber, PointIndex, POINT_TYPE_LENGTHS, iter_point_data
+)
+
+INDEX_NAMES = {point.value: point.name for point in PointIndex}
 
 
 def ts_print(*stuff):
@@ -22,56 +26,20 @@ def process_point_data(pstr):
     """
     Parse base64-encoded pointData into a dictionary
     Keys are the indices
-    Values are (datatype, dotted_bytes, integer_value)
+    Values are (index_name, datatype, dotted_bytes, integer_value)
     where datatype is 1, 2, 4, 5 (see API.md)
     """
-    lengths = {1: 1, 2: 2, 4: 2, 5: 4}
     parsed = {}
-    mode = "wait"
-    datatype = None
-    index = None
-    value = []
-
-    def bytes_to_int(byte_data):
-        """
-        Convert bytes to an integer, naively
-        """
-        result = 0
-        for a_byte in byte_data:
-            result = result * 256 + int(a_byte)
-        return result
-
-    for number in base64.b64decode(pstr):
-        if mode == "wait":
-            assert number == 0
-            mode = "index"
-            continue
-        if mode == "index":
-            index = number
-            mode = "datatype"
-            continue
-        if mode == "datatype":
-            datatype = number
-            if datatype not in lengths:
-                raise RuntimeError("Unknown datatype: {}".format(datatype))
-            mode = "value"
-            continue
-        if mode == "value":
-            value.append(number)
-            try:
-                index_lookup = PointIndex(index).name
-            except ValueError:
-                index_lookup = 'UNKNOWN'
-            if len(value) == lengths[datatype]:
-                parsed[index] = (
-                    index_lookup,
-                    datatype,
-                    ".".join([str(x) for x in value]),
-                    bytes_to_int(value)
-                )
-                value = []
-                mode = "wait"
-            continue
+    for index, datatype, value in iter_point_data(base64.b64decode(pstr)):
+        parsed[index] = (
+            INDEX_NAMES.get(index, 'UNKNOWN'),
+            datatype,
+            ".".join(
+                str(x) for x in value.to_bytes(POINT_TYPE_LENGTHS[datatype],
+                                               'big')
+            ),
+            value
+        )
     return parsed
 
 
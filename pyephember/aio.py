@@ -0,0 +1,707 @@
+"""
+Asyncio interface implementation for https://ember.ephcontrols.com/
+
+Requires aiohttp. MQTT is driven by paho on the running event loop,
+so neither HTTP requests nor publishes block it.
+"""
+# pylint: disable=consider-using-f-string
+
+import asyncio
+import datetime
+import threading
+import time
+
+import aiohttp
+import paho.mqtt.client as mqtt
+
+from .pyephember import (
+    ZoneCommand, ZoneMode,
+    boiler_state, zone_boost_commands, zone_boost_hours,
+    zone_boost_temperature,
+    zone_boost_timestamp, zone_commands_to_b64, zone_current_temperature,
+    zone_is_active, zone_is_boost_active, zone_mode,
+    zone_target_temperature,
+    _home_details_from_response, _homes_from_response,
+    _login_data_from_response, _pointdata_message_values,
+    _publish_context_for, _refresh_login_data, _token_expires_in,
+    _user_details, _zone_from_response, _zones_from_response
+)
+
+
+class _LoopSocketHelper:
+    """
+    Drive a paho client from an asyncio event loop instead of
+    a network thread, using the socket callbacks of the client
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self._loop_thread = threading.get_ident()
+        client.on_socket_open = self._threadsafe(self.on_socket_open)
+        client.on_socket_close = self._threadsafe(self.on_socket_close)
+        client.on_socket_register_write = self._threadsafe(
+            self.on_socket_register_write
+        )
+        client.on_socket_unregister_write = self._threadsafe(
+            self.on_socket_unregister_write
+        )
+
+    def _threadsafe(self, callback):
+        """
+        The connect runs in an executor, so socket callbacks may
+        come from another thread: hand those over to the loop
+        """
+        def wrapper(client, userdata, sock):
+            if threading.get_ident() == self._loop_thread:
+                callback(client, userdata, sock)
+            else:
+                self.loop.call_soon_threadsafe(
+                    callback, client, userdata, sock
+                )
+        return wrapper
+
+    # pylint: disable=unused-argument
+
+    def on_socket_open(self, client, userdata, sock):
+        """
+        Read from the socket whenever data arrives
+        """
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        """
+        Stop watching a closed socket
+        """
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        """
+        Write to the socket while paho has data queued
+        """
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        """
+        Nothing left to write
+        """
+        self.loop.remove_writer(sock)
+
+    # pylint: enable=unused-argument
+
+    async def misc_loop(self):
+        """
+        Keepalive pings and timeouts
+        """
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class AsyncEphMessenger:
+    """
+    Asyncio MQTT interface to the EphEmber API
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    async def _publish_context(self):
+        """
+        Get the publish context of the home, rebuilt only
+        when the home details change
+        """
+        self._context = _publish_context_for(
+            self._context, await self.parent.get_home_details()
+        )
+        return self._context
+
+    # pylint: disable=unused-argument
+
+    def _on_connect(self, client, userdata, flags, result_code):
+        if self._connected is not None and not self._connected.done():
+            if result_code == 0:
+                self._connected.set_result(True)
+            else:
+                self._connected.set_exception(RuntimeError(
+                    "MQTT connection refused: {}".format(result_code)
+                ))
+
+    def _on_publish(self, client, userdata, mid):
+        future = self._pending.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    def _on_disconnect(self, client, userdata, result_code):
+        """
+        End the pointdata() iterators, with an error if the connection
+        was lost rather than closed by stop()
+        """
+        if client is not self.client:
+            return
+        # is_connected() may still be true after a lost connection,
+        # so drop the client to have the next call reconnect
+        self.client = None
+        end = None
+        if result_code != 0:
+            end = RuntimeError(
+                "MQTT connection lost: {}".format(result_code)
+            )
+        for queue in self._queues:
+            queue.put_nowait(end)
+
+    def _on_message(self, client, userdata, message):
+        try:
+            decoded = _pointdata_message_values(message.payload)
+        except (ValueError, TypeError, AttributeError):
+            # drop malformed pushes
+            return
+        if decoded is not None:
+            for queue in self._queues:
+                queue.put_nowait(decoded)
+
+    # pylint: enable=unused-argument
+
+    async def _ensure_started(self):
+        if self.client is not None and self.client.is_connected():
+            return
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        # concurrent first callers share one connection
+        async with self._start_lock:
+            if self.client is None or not self.client.is_connected():
+                await self.start()
+
+    # Public interface
+
+    async def start(self):
+        """
+        Connect the MQTT client, driven by the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        credentials = await self.parent.messenging_credentials()
+        self.client_id = '{}_{}'.format(
+            credentials['user_id'], str(int(1000*time.time()))
+        )
+        token = credentials['token']
+
+        mclient = mqtt.Client(self.client_id)
+        if self.use_tls:
+            mclient.tls_set()
+        mclient.username_pw_set("app/{}".format(token), token)
+        mclient.on_connect = self._on_connect
+        mclient.on_disconnect = self._on_disconnect
+        mclient.on_publish = self._on_publish
+        mclient.on_message = self._on_message
+        _LoopSocketHelper(loop, mclient)
+        if self.client is not None:
+            # a previous, dropped connection
+            self.client.disconnect()
+        self.client = mclient
+
+        self._connected = loop.create_future()
+        # DNS, TCP and TLS handshakes are blocking in paho
+        await loop.run_in_executor(
+            None, mclient.connect, self.api_url, self.api_port
+        )
+        try:
+            await asyncio.wait_for(self._connected, self.connect_timeout)
+        except asyncio.TimeoutError:
+            mclient.disconnect()
+            raise RuntimeError("MQTT connection timed out") from None
+        return mclient
+
+    async def stop(self):
+        """
+        Disconnect MQTT client if connected
+        """
+        if not self.client:
+            return False
+        if self.client.is_connected():
+            self.client.disconnect()
+        return True
+
+    async def send_zone_commands(self, zone, commands, timeout=1):
+        """
+        Bundles the given array of ZoneCommand objects
+        to a single MQTT command and sends it to the zone.
+
+        Returns true if the command was published within the timeout.
+        """
+        await self._ensure_started()
+        context = await self._publish_context()
+        info = self.client.publish(
+            context.download_topic,
+            context.message(zone['mac'], zone_commands_to_b64(commands)), 0
+        )
+        if info.is_published():
+            return True
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[info.mid] = future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(info.mid, None)
+            return info.is_published()
+
+    async def pointdata(self):
+        """
+        Asynchronous iterator over pushed upload/pointdata messages,
+        yielding (mac, values) with values a dictionary of
+        point index -> integer value.
+
+        It ends when stop() disconnects, and raises RuntimeError if the
+        connection is lost.
+        """
+        await self._ensure_started()
+        topic = (await self._publish_context()).upload_topic
+        queue = asyncio.Queue()
+        self._queues.append(queue)
+        self.client.subscribe(topic, 0)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self._queues.remove(queue)
+            if (not self._queues and self.client is not None
+                    and self.client.is_connected()):
+                self.client.unsubscribe(topic)
+
+    def __init__(self, parent):
+
+        self.api_url = 'eu-base-mqtt.topband-cloud.com'
+        self.api_port = 18883
+        # plain TCP is only useful against a local test broker
+        self.use_tls = True
+        # seconds to wait for the broker to accept a connection
+        self.connect_timeout = 10
+
+        self.client = None
+        self.client_id = None
+
+        self.parent = parent
+
+        self._connected = None
+        self._start_lock = None
+        self._context = None
+        # mid -> future resolved by on_publish
+        self._pending = {}
+        # one queue per running pointdata() iterator
+        self._queues = []
+
+
+class AsyncEphEmber:
+    """
+    Interacts with a EphEmber thermostat via API, using asyncio.
+    Example usage:
+        async with AsyncEphEmber('me@somewhere.com', 'mypasswd') as t:
+            await t.get_zone_temperature('myzone')
+    """
+
+    # pylint: disable=too-many-public-methods
+    # pylint: disable=too-many-instance-attributes
+
+    # same keyword arguments as EphEmber._http
+    # pylint: disable-next=too-many-arguments
+    async def _http(self, endpoint, *, method="POST", headers=None,
+                    send_token=False, data=None, timeout=10):
+        """
+        Send a request to the http API endpoint and return its JSON
+        method should be "GET" or "POST"
+        """
+        if not headers:
+            headers = {}
+
+        if send_token:
+            if not await self._do_auth():
+                raise RuntimeError("Unable to login")
+            headers["Authorization"] = self._login_data["data"]["token"]
+
+        headers["Content-Type"] = "application/json"
+        headers["Accept"] = "application/json"
+
+        url = "{}{}".format(self.http_api_base, endpoint)
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+
+        async with self._session.request(
+                method, url, json=data, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            if response.status != 200:
+                raise RuntimeError(
+                    "{} response code".format(response.status)
+                )
+            return await response.json(content_type=None)
+
+    def _requires_refresh_token(self):
+        """
+        Check if a refresh of the token is needed
+        """
+        return _token_expires_in(
+            self._login_data, self._refresh_token_validity_seconds
+        ) < 30
+
+    async def _request_token(self, force=False):
+        """
+        Request a new auth token
+        """
+        if self._login_data is None:
+            raise RuntimeError("Don't have a token to refresh")
+
+        if not force and not self._requires_refresh_token():
+            return True
+
+        refresh_data = await self._http(
+            "appLogin/refreshAccessToken", method="GET",
+            headers={'Authorization':
+                     self._login_data['data']['refresh_token']}
+        )
+
+        return _refresh_login_data(self._login_data, refresh_data)
+
+    async def _login(self):
+        """
+        Login using username / password and get the first auth token
+        """
+        self._login_data = None
+
+        self._login_data = _login_data_from_response(await self._http(
+            "appLogin/login",
+            data={
+                'userName': self._user['username'],
+                'password': self._user['password']
+            }
+        ))
+        return self._login_data is not None
+
+    async def _do_auth(self):
+        """
+        Do authentication to the system (if required).
+        Concurrent callers share a single login or refresh.
+        """
+        async with self._auth_lock:
+            if self._login_data is None:
+                return await self._login()
+
+            try:
+                if await self._request_token():
+                    return True
+            except RuntimeError:
+                pass
+            # the refresh token was rejected as well
+            return await self._login()
+
+    async def _get_user_id(self):
+        """
+        Get user ID [user/selectUser]
+        """
+        if self._user['user_id']:
+            return self._user['user_id']
+
+        user_details = await self._http(
+            "user/selectUser", method="GET", send_token=True
+        )
+        data = user_details.get('data', {})
+        if user_details.get('status') != 0 or 'id' not in data:
+            raise RuntimeError("Cannot get user ID")
+        self._user['user_id'] = str(data['id'])
+        return self._user['user_id']
+
+    async def _get_first_gateway_id(self):
+        """
+        Get the first gatewayid associated with the account
+        """
+        if not self._homes:
+            self._homes = await self.list_homes()
+        if not self._homes:
+            raise RuntimeError("Cannot get gateway id from list of homes.")
+        return self._homes[0]['gatewayid']
+
+    async def _send_zone_commands(self, name, commands):
+        return await self.messenger.send_zone_commands(
+            await self.get_zone(name), commands
+        )
+
+    # Public interface
+
+    async def login(self):
+        """
+        Login to the API; other calls log in on demand if needed
+        """
+        if not await self._login():
+            raise RuntimeError("Unable to login.")
+
+    async def close(self):
+        """
+        Close the HTTP session and the MQTT connection
+        """
+        await self.messenger.stop()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        await self.login()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def messenging_credentials(self):
+        """
+        Credentials required by AsyncEphMessenger
+        """
+        if not await self._do_auth():
+            raise RuntimeError("Unable to login")
+
+        return {
+            'user_id': await self._get_user_id(),
+            'token': self._login_data["data"]["token"]
+        }
+
+    async def list_homes(self):
+        """
+        List the homes available for this user
+        """
+        return _homes_from_response(await self._http(
+            "homes/list", method="GET", send_token=True
+        ))
+
+    async def get_home_details(self, gateway_id=None, force=False):
+        """
+        Get the details about a home (API call: homes/detail)
+        If no gateway_id is passed, the first gateway found is used.
+        """
+        if self._home_details and not force:
+            return self._home_details
+
+        if gateway_id is None:
+            gateway_id = await self._get_first_gateway_id()
+
+        self._home_details = _home_details_from_response(await self._http(
+            "homes/detail", send_token=True, data={"gateWayId": gateway_id}
+        ))
+        return self._home_details
+
+    async def get_home(self, gateway_id=None):
+        """
+        Get the data about a home (API call: homesVT/zoneProgram).
+        If no gateway_id is passed, the first gateway found is used.
+        """
+        if gateway_id is None:
+            gateway_id = await self._get_first_gateway_id()
+
+        return _zones_from_response(await self._http(
+            "homesVT/zoneProgram", send_token=True,
+            data={"gateWayId": gateway_id}
+        ))
+
+    async def get_zones(self):
+        """
+        Get all zones
+        """
+        return await self.get_home() or []
+
+    async def get_zone_names(self):
+        """
+        Get the name of all zones
+        """
+        return [zone['name'] for zone in await self.get_zones()]
+
+    async def get_zone_by_id(self, zone_id):
+        """
+        Get the data about a single zone by its zoneid
+        (API call: homesVT/zoneViewProgram)
+        """
+        return _zone_from_response(await self._zone_view(zone_id))
+
+    async def _zone_view(self, zone_id):
+        """
+        The homesVT/zoneViewProgram response for a zoneid
+        """
+        return await self._http(
+            "homesVT/zoneViewProgram", send_token=True,
+            data={"zoneid": zone_id}
+        )
+
+    async def get_zone(self, name):
+        """
+        Get the information about a particular zone. Once its zoneid
+        is known the zone is fetched on its own, not with the whole home.
+        """
+        zone_id = self._zone_ids.get(name)
+        if zone_id is not None:
+            # transport and auth errors propagate
+            zone = _zone_from_response(
+                await self._zone_view(zone_id), missing_ok=True
+            )
+            if zone is not None and zone.get('name') == name:
+                return zone
+            # renamed or removed: fall back to the whole home
+
+        zones = await self.get_zones()
+        self._zone_ids = {
+            zone['name']: zone['zoneid'] for zone in zones if 'zoneid' in zone
+        }
+        for zone in zones:
+            if name == zone['name']:
+                return zone
+
+        raise RuntimeError("Unknown zone: %s" % name)
+
+    async def is_zone_active(self, name):
+        """
+        Check if a zone is active
+        """
+        return zone_is_active(await self.get_zone(name))
+
+    async def is_zone_boiler_on(self, name):
+        """
+        Check if the named zone's boiler is on and burning fuel (experimental)
+        """
+        return boiler_state(await self.get_zone(name)) == 2
+
+    async def get_zone_temperature(self, name):
+        """
+        Get the temperature for a zone
+        """
+        return zone_current_temperature(await self.get_zone(name))
+
+    async def get_zone_target_temperature(self, name):
+        """
+        Get the temperature for a zone
+        """
+        return zone_target_temperature(await self.get_zone(name))
+
+    async def get_zone_boost_temperature(self, name):
+        """
+        Get the boost target temperature for a zone
+        """
+        return zone_boost_temperature(await self.get_zone(name))
+
+    async def is_boost_active(self, name):
+        """
+        Check if boost is active for a zone
+        """
+        return zone_is_boost_active(await self.get_zone(name))
+
+    async def boost_hours(self, name):
+        """
+        Get the boost duration for a zone, in hours
+        """
+        return zone_boost_hours(await self.get_zone(name))
+
+    async def boost_timestamp(self, name):
+        """
+        Get the timestamp recorded for the boost
+        """
+        return datetime.datetime.fromtimestamp(
+            zone_boost_timestamp(await self.get_zone(name))
+        )
+
+    async def is_target_temperature_reached(self, name):
+        """
+        Check if a zone temperature has reached the target temperature
+        """
+        zone = await self.get_zone(name)
+        return zone_current_temperature(zone) >= zone_target_temperature(zone)
+
+    async def get_zone_mode(self, name):
+        """
+        Get the mode for a zone
+        """
+        return zone_mode(await self.get_zone(name))
+
+    async def set_zone_target_temperature(self, name, target_temperature):
+        """
+        Set the target temperature for a named zone
+        """
+        return await self._send_zone_commands(
+            name, ZoneCommand('TARGET_TEMP', target_temperature)
+        )
+
+    async def set_zone_boost_temperature(self, name, target_temperature):
+        """
+        Set the boost target temperature for a named zone
+        """
+        return await self._send_zone_commands(
+            name, ZoneCommand('BOOST_TEMP', target_temperature)
+        )
+
+    async def set_zone_advance(self, name, advance_state=True):
+        """
+        Set the advance state for a named zone
+        """
+        return await self._send_zone_commands(
+            name, ZoneCommand('ADVANCE_ACTIVE', 1 if advance_state else 0)
+        )
+
+    async def activate_zone_boost(self, name, boost_temperature=None,
+                                  num_hours=1, timestamp=0):
+        """
+        Turn on boost for a named zone, see EphEmber.activate_zone_boost
+        """
+        return await self._send_zone_commands(
+            name, zone_boost_commands(boost_temperature, num_hours, timestamp)
+        )
+
+    async def deactivate_zone_boost(self, name):
+        """
+        Turn off boost for a named zone
+        """
+        return await self.activate_zone_boost(
+            name, num_hours=0, timestamp=None
+        )
+
+    async def set_zone_mode(self, name, mode):
+        """
+        Set the mode by using the name of the zone
+        Supported zones are available in the enum ZoneMode
+        """
+        if isinstance(mode, int):
+            mode = ZoneMode(mode)
+
+        assert isinstance(mode, ZoneMode)
+
+        return await self._send_zone_commands(
+            name, ZoneCommand('MODE', mode.value)
+        )
+
+    def reset_login(self):
+        """
+        reset the login data to force a re-login
+        """
+        self._login_data = None
+
+    # Ctor
+    def __init__(self, username, password, session=None):
+        """
+        No I/O is done here: login happens in login(), on entering the
+        async context, or on the first call that needs a token.
+        An aiohttp.ClientSession may be passed as session.
+        """
+        self._login_data = None
+        self._user = _user_details(username, password)
+        self._homes = None
+        self._home_details = None
+        # zone name -> zoneid, for single zone requests (see get_zone)
+        self._zone_ids = {}
+        self._refresh_token_validity_seconds = 1800
+        self._auth_lock = asyncio.Lock()
+        self._session = session
+
+        self.http_api_base = 'https://eu-https.topband-cloud.com/ember-back/'
+
+        self.messenger = AsyncEphMessenger(self)
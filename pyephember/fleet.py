@@ -0,0 +1,404 @@
+"""
+Fleet management of many EphEmber accounts and gateways
+"""
+# pylint: disable=consider-using-f-string
+
+import collections
+import concurrent.futures
+import queue
+import threading
+import time
+
+from .pyephember import EphEmber, RateLimiter
+
+
+# """
+# Named tuple holding the result of a fleet refresh:
+# zones is a list of zone dicts tagged with 'account' and 'gatewayid',
+# errors maps (account, gateway_id) to the exception raised for it
+# (gateway_id is None if the account itself failed)
+# """
+FleetRefresh = collections.namedtuple('FleetRefresh', ['zones', 'errors'])
+
+# """
+# Named tuple holding a point data push received by a FleetSubscriber:
+# values maps point index to value for the zone mac (named name) of
+# gateway gateway_id of account, received at timestamp (seconds)
+# """
+FleetEvent = collections.namedtuple(
+    'FleetEvent',
+    ['account', 'gateway_id', 'mac', 'name', 'values', 'timestamp']
+)
+
+
+class _CallTimer:
+    """
+    Start times of the calls of an EphFleet._run and the last time the
+    pool made progress, to tell when calls have timed out
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        # key -> time the call started
+        self.started = {}
+        self.progress = time.monotonic()
+
+    def timed(self, func):
+        """
+        Wrap func(key) to record when a worker starts it
+        """
+        def call(key):
+            self.started[key] = time.monotonic()
+            return func(key)
+        return call
+
+    def wait_time(self, keys):
+        """
+        Seconds until the first of the calls for keys may time out
+        """
+        first = min(
+            [self.progress]
+            + [self.started[key] for key in keys if key in self.started]
+        )
+        return max(0, first + self.timeout - time.monotonic())
+
+    def expired(self, progressed, keys):
+        """
+        Note the progress of the pool and return the keys of the calls
+        that timed out. A call waiting for a worker only times out when
+        the pool made no progress for timeout seconds.
+        """
+        now = time.monotonic()
+        if progressed or any(
+                self.started.get(key, 0) > self.progress for key in keys):
+            self.progress = now
+        return {
+            key for key in keys
+            if now - self.started.get(key, self.progress) >= self.timeout
+        }
+
+
+class EphFleet:
+    """
+    Holds many EphEmber accounts and refreshes all of their gateways
+    concurrently with at most max_workers requests in flight.
+
+    Example usage: fleet = EphFleet(max_workers=16)
+                   fleet.add_account('me@somewhere.com', 'mypasswd')
+                   result = fleet.refresh()
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def _client(self, account):
+        """
+        Get the client for an account, logging in on first use.
+        Concurrent first uses of an account share one client, while
+        different accounts log in concurrently.
+        """
+        with self._clients_lock:
+            client = self._clients.get(account)
+            if client is not None:
+                return client
+            lock = self._account_locks.setdefault(account, threading.Lock())
+        with lock:
+            with self._clients_lock:
+                client = self._clients.get(account)
+            if client is None:
+                client = EphEmber(
+                    account, self._credentials[account],
+                    **self._ember_kwargs
+                )
+                with self._clients_lock:
+                    self._clients[account] = client
+        return client
+
+    def _run(self, func, keys, errors):
+        """
+        Run func(key) for all keys on the pool and return
+        {key: result} for the calls that finished in time.
+        Failed and timed out calls are recorded in errors.
+
+        Each call gets timeout seconds from when a worker starts it, so
+        calls waiting for a free worker are not timed out; those are
+        only given up on if the pool makes no progress for timeout
+        seconds (all workers stuck on calls that already timed out).
+        """
+        timer = _CallTimer(self.timeout)
+        futures = {
+            self._executor.submit(timer.timed(func), key): key
+            for key in keys
+        }
+        pending = set(futures)
+        results = {}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=timer.wait_time(futures[future] for future in pending),
+                return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                key = futures[future]
+                try:
+                    results[key] = future.result()
+                except Exception as exc:  # pylint: disable=broad-except
+                    errors[key] = exc
+            expired = timer.expired(
+                done, [futures[future] for future in pending]
+            )
+            for future in list(pending):
+                if futures[future] in expired:
+                    pending.discard(future)
+                    future.cancel()
+                    errors[futures[future]] = concurrent.futures.TimeoutError(
+                        "No response within {} seconds".format(self.timeout)
+                    )
+        return results
+
+    # Public interface
+
+    def add_account(self, username, password):
+        """
+        Add an account; login happens concurrently on the first refresh
+        """
+        self._credentials[username] = password
+        self._gateways.pop(username, None)
+
+    def add_client(self, client, account=None):
+        """
+        Add an already constructed EphEmber client
+        """
+        # pylint: disable=protected-access
+        if account is None:
+            account = client._user['username']
+        with self._clients_lock:
+            self._clients[account] = client
+        self._gateways.pop(account, None)
+
+    def remove_account(self, account):
+        """
+        Forget an account and its gateways
+        """
+        self._credentials.pop(account, None)
+        with self._clients_lock:
+            self._clients.pop(account, None)
+        self._gateways.pop(account, None)
+
+    def accounts(self):
+        """
+        Names of all accounts in the fleet
+        """
+        return sorted(set(self._credentials) | set(self._clients))
+
+    def discover(self, force=False):
+        """
+        Find the gateways of every account, concurrently.
+        Returns (gateways, errors) with gateways a list of
+        (account, gateway_id) pairs.
+        """
+        errors = {}
+        pending = [
+            account for account in self.accounts()
+            if force or account not in self._gateways
+        ]
+        found = self._run(
+            lambda account: self._client(account).get_gateway_ids(
+                force=force
+            ),
+            pending, errors
+        )
+        self._gateways.update(found)
+        gateways = [
+            (account, gateway_id)
+            for account in self.accounts()
+            for gateway_id in self._gateways.get(account, [])
+        ]
+        return gateways, {
+            (account, None): exc for account, exc in errors.items()
+        }
+
+    def refresh(self, rediscover=False):
+        """
+        Fetch the zones of every gateway of every account concurrently.
+
+        A slow or failing gateway does not hold up the others: it is
+        reported in the errors of the returned FleetRefresh instead.
+        """
+        gateways, errors = self.discover(force=rediscover)
+
+        homes = self._run(
+            lambda key: self._client(key[0]).get_home(key[1], force=True),
+            gateways, errors
+        )
+
+        zones = []
+        for account, gateway_id in gateways:
+            # tag copies: the clients may hold the dicts in their caches
+            for zone in homes.get((account, gateway_id), []):
+                zones.append(
+                    dict(zone, account=account, gatewayid=gateway_id)
+                )
+        return FleetRefresh(zones, errors)
+
+    def close(self):
+        """
+        Close all clients and stop the worker pool
+        without waiting for requests still in flight
+        """
+        self._executor.shutdown(wait=False)
+        for client in self._clients.values():
+            client.close()
+
+    def __init__(self, max_workers=8, timeout=30, total_rate_limit=None,
+                 **ember_kwargs):
+        """
+        max_workers bounds the number of concurrent requests and
+        timeout (seconds) bounds how long a refresh waits for each
+        request, from when it starts. total_rate_limit limits the HTTP
+        requests per second of all the accounts together. ember_kwargs
+        are passed to each EphEmber, e.g. rate_limit for a per account
+        limit.
+        """
+        self.timeout = timeout
+        self.rate_limiter = (
+            RateLimiter(total_rate_limit) if total_rate_limit else None
+        )
+        if self.rate_limiter is not None:
+            ember_kwargs = dict(ember_kwargs, rate_limiter=self.rate_limiter)
+        self._ember_kwargs = ember_kwargs
+        self._credentials = {}
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        # account -> lock held while its client is created
+        self._account_locks = {}
+        # account -> list of gateway ids
+        self._gateways = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        )
+
+
+class FleetSubscriber:
+    """
+    Receives the upload/pointdata pushes of every gateway of an EphFleet
+    as one stream of FleetEvent.
+
+    MQTT credentials are per account, so each account needs a connection
+    of its own, but all the gateways of an account share it: pushes are
+    routed to their gateway by topic and to their zone by MAC.
+
+    Example usage: subscriber = FleetSubscriber(fleet)
+                   errors = subscriber.start()
+                   for event in subscriber.events():
+                       print(event.gateway_id, event.name, event.values)
+
+    Events are also passed to the callbacks added with subscribe, on the
+    connection's thread. At most maxsize events wait in the stream;
+    later ones are counted in dropped instead.
+    """
+
+    def _on_pointdata(self, account, gateway_id, names):
+        """
+        Make the on_pointdata callback of a gateway
+        """
+        def on_pointdata(mac, values):
+            event = FleetEvent(
+                account, gateway_id, mac, names.get(mac), values, time.time()
+            )
+            for callback in list(self._callbacks):
+                callback(event)
+            try:
+                self._events.put_nowait(event)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+        return on_pointdata
+
+    def _subscribe_account(self, account, gateway_ids):
+        """
+        Subscribe to the pushes of the gateways of an account
+        on the account's connection
+        """
+        # pylint: disable=protected-access
+        client = self._fleet._client(account)
+        for gateway_id in gateway_ids:
+            home_details = client.get_home_details(gateway_id)
+            names = {
+                zone.mac: zone.name
+                for zone in client.get_static_zones(gateway_id)
+            }
+            client.messenger.subscribe_pointdata(
+                self._on_pointdata(account, gateway_id, names),
+                home_details
+            )
+            with self._lock:
+                self._subscriptions.append((client, home_details))
+        return len(gateway_ids)
+
+    # Public interface
+
+    def start(self, rediscover=False):
+        """
+        Discover the gateways of the fleet and subscribe to all of them,
+        one account at a time per worker of the fleet.
+        Returns {(account, gateway_id or None): exception} for the
+        accounts that could not be subscribed.
+        """
+        gateways, errors = self._fleet.discover(force=rediscover)
+        by_account = collections.defaultdict(list)
+        for account, gateway_id in gateways:
+            by_account[account].append(gateway_id)
+
+        account_errors = {}
+        self._fleet._run(  # pylint: disable=protected-access
+            lambda account: self._subscribe_account(
+                account, by_account[account]
+            ),
+            list(by_account), account_errors
+        )
+        for account, exc in account_errors.items():
+            errors[(account, None)] = exc
+        return errors
+
+    def stop(self):
+        """
+        Unsubscribe from all gateways
+        """
+        with self._lock:
+            subscriptions = self._subscriptions
+            self._subscriptions = []
+        for client, home_details in subscriptions:
+            client.messenger.unsubscribe_pointdata(home_details)
+
+    def subscribe(self, callback):
+        """
+        Call callback(event) for every FleetEvent
+        """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        """
+        Stop calling a callback added with subscribe
+        """
+        self._callbacks.remove(callback)
+
+    def events(self, timeout=None):
+        """
+        Iterate over received FleetEvents, in order of arrival.
+        Stops after timeout seconds without an event,
+        or never if timeout is None.
+        """
+        while True:
+            try:
+                yield self._events.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def __init__(self, fleet, maxsize=10000):
+        self._fleet = fleet
+        self._events = queue.Queue(maxsize)
+        self._callbacks = []
+        # (client, home_details) of every subscribed gateway
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self.dropped = 0
@@ -0,0 +1,278 @@
+"""
+Multi-process decoding of MQTT upload/pointdata pushes
+"""
+# pylint: disable=consider-using-f-string
+
+import multiprocessing
+import threading
+import time
+import zlib
+
+from .pyephember import (
+    _pointdata_message_values, pointdata_messages_to_values
+)
+
+# what a malformed payload raises while decoding; ValueError also
+# covers JSON, UTF-8 and base64 errors
+_DECODE_ERRORS = (ValueError, AttributeError, TypeError)
+
+
+def _payload_mac(payload):
+    """
+    MAC of a raw pointdata payload, found without parsing the JSON,
+    or b'' if there is none
+    """
+    pos = payload.find(b'"mac"')
+    if pos < 0:
+        return b''
+    colon = payload.find(b':', pos + 5)
+    start = payload.find(b'"', colon + 1) if colon >= 0 else -1
+    end = payload.find(b'"', start + 1) if start >= 0 else -1
+    if end < 0:
+        return b''
+    return payload[start + 1:end]
+
+
+def _decode_batch(payloads):
+    """
+    Decode a batch of payloads into ((mac, values) list, error count),
+    skipping the payloads that can't be decoded
+    """
+    try:
+        decoded = pointdata_messages_to_values(payloads)
+    except _DECODE_ERRORS:
+        # find the bad payloads one at a time
+        decoded = []
+        for payload in payloads:
+            try:
+                decoded.append(_pointdata_message_values(payload))
+            except _DECODE_ERRORS:
+                decoded.append(False)
+    results = [item for item in decoded if item]
+    return results, decoded.count(False)
+
+
+def _worker(index, inbox, outbox):
+    """
+    Worker process: decode batches from inbox until None arrives,
+    sending (index, results, errors, busy seconds) to outbox
+    """
+    while True:
+        batch = inbox.get()
+        if batch is None:
+            outbox.put((index, None, 0, 0.0))
+            return
+        start = time.perf_counter()
+        results, errors = _decode_batch(batch)
+        outbox.put((index, results, errors, time.perf_counter() - start))
+
+
+class IngestPipeline:
+    """
+    Decodes raw upload/pointdata payloads on a pool of worker processes,
+    so that ingest is not limited to the core running the MQTT loop.
+
+    Payloads are sharded by zone MAC: all the pushes of a zone are
+    decoded by the same worker, and on_pointdata(mac, values) is called
+    for them in the order they were submitted, from a single thread.
+
+    Each worker has a queue of at most queue_size batches of up to
+    batch_size payloads. When it is full, submit blocks, which in turn
+    holds up the MQTT loop and the broker connection.
+
+    Example usage: pipeline = IngestPipeline(watcher.apply_pointdata)
+                   pipeline.start()
+                   client.on_message = pipeline.on_message
+                   ...
+                   pipeline.stop()
+                   print(pipeline.stats())
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def _send(self, shard):
+        """
+        Queue the pending batch of a shard for its worker
+        """
+        with self._pending_locks[shard]:
+            batch = self._pending[shard]
+            if not batch:
+                return
+            self._pending[shard] = []
+            start = time.perf_counter()
+            self._inboxes[shard].put(batch)
+            blocked = time.perf_counter() - start
+        with self._stats_lock:
+            self._blocked += blocked
+            self._batches += 1
+
+    def _flusher(self):
+        """
+        Send partly filled batches every max_delay seconds
+        """
+        while not self._stopping.wait(self.max_delay):
+            for shard in range(self.workers):
+                self._send(shard)
+
+    def _collector(self):
+        """
+        Deliver decoded point data until every worker has stopped
+        """
+        running = self.workers
+        while running:
+            index, results, errors, busy = self._outbox.get()
+            if results is None:
+                running -= 1
+                continue
+            with self._stats_lock:
+                self._decoded[index] += len(results)
+                self._errors += errors
+                self._busy[index] += busy
+            failed = 0
+            for mac, values in results:
+                try:
+                    self.on_pointdata(mac, values)
+                except Exception:  # pylint: disable=broad-except
+                    # keep delivering: a dead collector would stall stop()
+                    failed += 1
+            with self._stats_lock:
+                self._delivered += len(results) - failed
+                self._callback_errors += failed
+
+    # Public interface
+
+    def submit(self, payload):
+        """
+        Queue a raw upload/pointdata payload (bytes) for decoding
+        """
+        shard = zlib.crc32(_payload_mac(payload)) % self.workers
+        with self._pending_locks[shard]:
+            batch = self._pending[shard]
+            batch.append(payload)
+            full = len(batch) >= self.batch_size
+        with self._stats_lock:
+            self._submitted += 1
+        if full:
+            self._send(shard)
+
+    def on_message(self, client, userdata, message):
+        """
+        paho on_message callback submitting the message payload
+        """
+        # pylint: disable=unused-argument
+        self.submit(message.payload)
+
+    def flush(self):
+        """
+        Send all partly filled batches to the workers now
+        """
+        for shard in range(self.workers):
+            self._send(shard)
+
+    def start(self):
+        """
+        Start the worker processes and the delivery thread
+        """
+        context = multiprocessing.get_context()
+        self._inboxes = [
+            context.Queue(self.queue_size) for _ in range(self.workers)
+        ]
+        self._outbox = context.Queue()
+        self._processes = [
+            context.Process(
+                target=_worker, args=(index, inbox, self._outbox),
+                daemon=True
+            )
+            for index, inbox in enumerate(self._inboxes)
+        ]
+        for process in self._processes:
+            process.start()
+        self._stopping.clear()
+        self._threads = [
+            threading.Thread(target=self._flusher, daemon=True),
+            threading.Thread(target=self._collector, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        self._started = time.monotonic()
+        return self
+
+    def stop(self):
+        """
+        Decode and deliver everything submitted, then stop the workers
+        """
+        self._stopping.set()
+        flusher, collector = self._threads
+        flusher.join()
+        self.flush()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        collector.join()
+        for process in self._processes:
+            process.join()
+        self._stopped = time.monotonic()
+
+    def stats(self):
+        """
+        Counters and throughput (per second of wall time) of each stage:
+        submitted payloads, decoded pushes (also per second of worker
+        time, per worker) and pushes delivered to on_pointdata.
+        errors counts payloads that could not be decoded and
+        callback_errors the exceptions raised by on_pointdata.
+        backpressure_s is the time submit spent waiting for full queues.
+        """
+        end = self._stopped or time.monotonic()
+        elapsed = max(end - (self._started or end), 1e-9)
+        with self._stats_lock:
+            decoded = sum(self._decoded)
+            return {
+                'workers': self.workers,
+                'elapsed_s': elapsed,
+                'submitted': self._submitted,
+                'batches': self._batches,
+                'decoded': decoded,
+                'delivered': self._delivered,
+                'errors': self._errors,
+                'callback_errors': self._callback_errors,
+                'backpressure_s': self._blocked,
+                'submit_per_s': self._submitted / elapsed,
+                'decode_per_s': decoded / elapsed,
+                'deliver_per_s': self._delivered / elapsed,
+                'worker_decode_per_s': [
+                    count / busy if busy else 0.0
+                    for count, busy in zip(self._decoded, self._busy)
+                ],
+            }
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, on_pointdata, workers=None, queue_size=64,
+                 batch_size=64, max_delay=0.05):
+        """
+        workers defaults to the number of CPUs. Partly filled batches
+        are sent after at most max_delay seconds.
+        """
+        self.on_pointdata = on_pointdata
+        self.workers = workers or multiprocessing.cpu_count()
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+
+        self._pending = [[] for _ in range(self.workers)]
+        self._pending_locks = [threading.Lock() for _ in range(self.workers)]
+        self._inboxes = []
+        self._outbox = None
+        self._processes = []
+        self._threads = []
+        self._stopping = threading.Event()
+
+        self._stats_lock = threading.Lock()
+        self._started = None
+        self._stopped = None
+        self._submitted = 0
+        self._batches = 0
+        self._delivered = 0
+        self._errors = 0
+        self._callback_errors = 0
+        self._blocked = 0.0
+        self._decoded = [0] * self.workers
+        self._busy = [0.0] * self.workers
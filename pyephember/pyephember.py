@@ -2,17 +2,39 @@
 PyEphEmber interface implementation for https://ember.ephcontrols.com/
 """
 # pylint: disable=consider-using-f-string
+# the codec, zone helpers and clients stay in one module, which
+# aio, fleet, recorder and shm import their shared pieces from
+# pylint: disable=too-many-lines
 
 import base64
+import binascii
+import bisect
 import datetime
+import functools
 import json
+import logging
+import os
+import random
+import tempfile
+import threading
 import time
 import collections
 
 from enum import Enum
 
-import requests
-import paho.mqtt.client as mqtt
+_LOGGER = logging.getLogger(__name__)
+
+# requests and paho.mqtt are imported on first use, see _mqtt and
+# EphEmber._make_session, so the zone helpers can be imported cheaply
+
+
+def _mqtt():
+    """
+    The paho.mqtt.client module, imported on first use
+    """
+    # pylint: disable=import-outside-toplevel
+    import paho.mqtt.client as mqtt
+    return mqtt
 
 
 class ZoneMode(Enum):
@@ -49,38 +71,292 @@ class PointIndex(Enum):
 # """
 ZoneCommand = collections.namedtuple('ZoneCommand', ['name', 'value'])
 
+# PointIndex name -> index, to avoid Enum lookups on every read
+_POINT_INDEX_VALUES = {point.name: point.value for point in PointIndex}
+_POINT_SLOTS = max(_POINT_INDEX_VALUES.values()) + 1
+
+
+class Zone:
+    """
+    Zone data parsed once from a zoneProgram snapshot.
+    Point values are held in a list indexed by point index, so reads
+    don't scan pointDataList. Other keys are read from the raw data,
+    so a Zone can be used wherever a zone dict is expected.
+    """
+    __slots__ = ('data', 'points', 'schedule')
+
+    def __init__(self, data):
+        self.data = data
+        self.schedule = None
+        points = [None] * _POINT_SLOTS
+        for datum in data['pointDataList']:
+            index = datum['pointIndex']
+            if index >= len(points):
+                points.extend([None] * (index + 1 - len(points)))
+            points[index] = int(datum['value'])
+        self.points = points
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        """
+        Raw zone data for key, as dict.get
+        """
+        return self.data.get(key, default)
+
+    def point(self, index):
+        """
+        Value of the given integer point index, or None
+        """
+        if 0 <= index < len(self.points):
+            return self.points[index]
+        return None
+
+
+def _schedule_minutes(stime):
+    """
+    Minutes since midnight of a program time like 173 for 17:30
+    """
+    stime = int(stime)
+    return (stime // 10) * 60 + (stime % 10) * 10
+
+
+class ZoneSchedule:
+    """
+    Weekly program of a zone (its deviceDays) compiled into sorted
+    tables of the seconds within a UTC week at which the zone turns
+    on or off, for the AUTO and ALL_DAY modes.
+
+    Times in the program are integers like 173 for 17:30, and a period
+    includes the whole minute of its end time.
+    """
+    __slots__ = ('_tables',)
+
+    WEEK = 7 * 86400
+    # dayType 0 is Sunday; 1970-01-01 (Unix time 0) was a Thursday
+    _EPOCH_OFFSET = 4 * 86400
+
+    _minutes = staticmethod(_schedule_minutes)
+
+    @classmethod
+    def _table(cls, periods):
+        """
+        Merge (day, start, end) periods into (on_at_week_start,
+        transitions) with transitions in seconds since start of week
+        """
+        intervals = sorted(
+            (day * 86400 + cls._minutes(start) * 60,
+             day * 86400 + cls._minutes(end) * 60 + 60)
+            for day, start, end in periods
+            # a period ending before it starts is never on
+            if cls._minutes(end) >= cls._minutes(start)
+        )
+        bounds = []
+        for start, end in intervals:
+            if bounds and start <= bounds[-1]:
+                bounds[-1] = max(bounds[-1], end)
+            else:
+                bounds.extend((start, end))
+        on_at_start = False
+        if bounds and bounds[0] == 0 and bounds[-1] >= cls.WEEK:
+            # on across the end of the week: not a transition
+            on_at_start = True
+            bounds = bounds[1:-1]
+        return on_at_start, bounds
+
+    def __init__(self, device_days):
+        auto = []
+        all_day = []
+        for day in device_days:
+            day_type = day['dayType']
+            for period in ['p1', 'p2', 'p3']:
+                auto.append((
+                    day_type,
+                    day[period]['startTime'], day[period]['endTime']
+                ))
+            all_day.append((
+                day_type, day['p1']['startTime'], day['p3']['endTime']
+            ))
+        self._tables = {
+            ZoneMode.AUTO: self._table(auto),
+            ZoneMode.ALL_DAY: self._table(all_day),
+        }
+
+    def is_on(self, timestamp, mode=ZoneMode.AUTO):
+        """
+        Is the zone scheduled on at the Unix timestamp (seconds)
+        """
+        if mode == ZoneMode.ON:
+            return True
+        if mode == ZoneMode.OFF:
+            return False
+        on_at_start, bounds = self._tables[mode]
+        offset = (int(timestamp) + self._EPOCH_OFFSET) % self.WEEK
+        return on_at_start != (bisect.bisect_right(bounds, offset) % 2 == 1)
+
+    def next_transition(self, timestamp, mode=ZoneMode.AUTO):
+        """
+        Unix timestamp (seconds) of the next time after timestamp at
+        which the schedule turns on or off, or None if it never does
+        """
+        if mode in (ZoneMode.ON, ZoneMode.OFF):
+            return None
+        bounds = self._tables[mode][1]
+        if not bounds:
+            return None
+        timestamp = int(timestamp)
+        offset = (timestamp + self._EPOCH_OFFSET) % self.WEEK
+        position = bisect.bisect_right(bounds, offset)
+        if position < len(bounds):
+            return timestamp + bounds[position] - offset
+        return timestamp + bounds[0] + self.WEEK - offset
+
+    def is_on_array(self, timestamps, mode=ZoneMode.AUTO):
+        """
+        Vectorized is_on over an array of Unix timestamps (seconds),
+        returning a numpy array of booleans. Requires numpy.
+        """
+        import numpy  # pylint: disable=import-outside-toplevel
+
+        timestamps = numpy.asarray(timestamps)
+        if mode in (ZoneMode.ON, ZoneMode.OFF):
+            return numpy.full(timestamps.shape, mode == ZoneMode.ON)
+        on_at_start, bounds = self._tables[mode]
+        offsets = (
+            numpy.floor(timestamps).astype(numpy.int64) + self._EPOCH_OFFSET
+        ) % self.WEEK
+        positions = numpy.searchsorted(
+            numpy.asarray(bounds, dtype=numpy.int64), offsets, side='right'
+        )
+        return (positions % 2 == 1) != on_at_start
+
+
+class ZoneIndex:
+    """
+    The zones of a snapshot with name -> zone and mac -> zone indexes
+    """
+    __slots__ = ('source', 'zones', 'by_name', 'by_mac')
+
+    def __init__(self, zones):
+        self.source = zones
+        self.zones = [
+            zone if isinstance(zone, Zone) else Zone(zone) for zone in zones
+        ]
+        self.by_name = {zone['name']: zone for zone in self.zones}
+        self.by_mac = {zone['mac']: zone for zone in self.zones}
+
+    def __iter__(self):
+        return iter(self.zones)
+
+    def __len__(self):
+        return len(self.zones)
+
+    def __getitem__(self, position):
+        return self.zones[position]
+
+    def get_zone(self, name):
+        """
+        Get the zone with the given name
+        """
+        try:
+            return self.by_name[name]
+        except KeyError:
+            raise RuntimeError("Unknown zone: %s" % name) from None
+
+
+# """
+# Named tuple holding the static data of a zone, which rarely changes:
+# its name, mac, zoneid, weekly program (deviceDays) and the program
+# compiled into a ZoneSchedule
+# """
+ZoneStatic = collections.namedtuple(
+    'ZoneStatic', ['name', 'mac', 'zoneid', 'device_days', 'schedule']
+)
+
+
+class _StaticHome:
+    """
+    Static data of the zones of a home, valid until expiry
+    on the monotonic clock
+    """
+    __slots__ = ('expiry', 'zones', 'by_name', 'by_mac')
+
+    def __init__(self, zones, expiry):
+        self.expiry = expiry
+        self.zones = [
+            ZoneStatic(
+                zone['name'], zone['mac'], zone.get('zoneid'),
+                zone['deviceDays'], ZoneSchedule(zone['deviceDays'])
+            )
+            for zone in zones
+        ]
+        self.by_name = {zone.name: zone for zone in self.zones}
+        self.by_mac = {zone.mac: zone for zone in self.zones}
+
+    def fresh(self):
+        """
+        Is the static data still valid
+        """
+        return self.expiry > time.monotonic()
+
+    def matches(self, zones):
+        """
+        Does a snapshot have the same zones, with the same names
+        and weekly programs
+        """
+        if len(zones) != len(self.by_mac):
+            return False
+        for zone in zones:
+            static = self.by_mac.get(zone['mac'])
+            if (static is None or static.name != zone['name']
+                    or static.device_days != zone['deviceDays']):
+                return False
+        return True
+
+
+# Point types: id and length in bytes of the value
+POINT_TYPES = {
+    'SMALL_INT': {'id': 1, 'byte_len': 1},
+    'TEMP_RO': {'id': 2, 'byte_len': 2},
+    'TEMP_RW': {'id': 4, 'byte_len': 2},
+    'TIMESTAMP': {'id': 5, 'byte_len': 4}
+}
+
+# Point type id -> length in bytes of the value
+POINT_TYPE_LENGTHS = {
+    point_type['id']: point_type['byte_len']
+    for point_type in POINT_TYPES.values()
+}
+
+# Point type of each writable PointIndex
+WRITABLE_POINT_TYPES = {
+    'ADVANCE_ACTIVE': 'SMALL_INT',
+    'TARGET_TEMP': 'TEMP_RW',
+    'MODE': 'SMALL_INT',
+    'BOOST_HOURS': 'SMALL_INT',
+    'BOOST_TIME': 'TIMESTAMP',
+    'BOOST_TEMP': 'TEMP_RW'
+}
+
 
 def zone_command_to_ints(command):
     """
     Convert a ZoneCommand to an array of integers to send
     """
-    type_data = {
-        'SMALL_INT': {'id': 1, 'byte_len': 1},
-        'TEMP_RO': {'id': 2, 'byte_len': 2},
-        'TEMP_RW': {'id': 4, 'byte_len': 2},
-        'TIMESTAMP': {'id': 5, 'byte_len': 4}
-    }
-    writable_command_types = {
-        'ADVANCE_ACTIVE': 'SMALL_INT',
-        'TARGET_TEMP': 'TEMP_RW',
-        'MODE': 'SMALL_INT',
-        'BOOST_HOURS': 'SMALL_INT',
-        'BOOST_TIME': 'TIMESTAMP',
-        'BOOST_TEMP': 'TEMP_RW'
-    }
-    if command.name not in writable_command_types:
+    if command.name not in WRITABLE_POINT_TYPES:
         raise ValueError(
             "Cannot write to read-only value "
             "{}".format(command.name)
         )
 
-    command_type = writable_command_types[command.name]
+    command_type = WRITABLE_POINT_TYPES[command.name]
     command_index = PointIndex[command.name].value
 
-    # command header: [0, index, type_id]
-    int_array = [0, command_index, type_data[command_type]['id']]
-
-    # now encode and append the value
+    # encode the value
     send_value = command.value
     if command_type == 'TEMP_RW':
         # The thermostat uses tenths of a degree;
@@ -92,11 +368,129 @@ def zone_command_to_ints(command):
         if isinstance(command.value, datetime.datetime):
             send_value = int(command.value.timestamp())
 
-    for byte_value in send_value.to_bytes(
-            type_data[command_type]['byte_len'], 'big'):
-        int_array.append(int(byte_value))
+    # [0, index, type_id, value bytes...]
+    return list(encode_point_data(
+        [(command_index, POINT_TYPES[command_type]['id'], send_value)]
+    ))
+
+
+@functools.lru_cache(maxsize=1024)
+def _zone_command_bytes(command):
+    """
+    Encoded bytes of a ZoneCommand, cached as bulk sends
+    tend to repeat the same few commands
+    """
+    return bytes(zone_command_to_ints(command))
+
+
+def iter_point_data(raw):
+    """
+    Iterate over the (index, point type, value) records of binary
+    pointData. Each record is a 2 byte index (the first byte has always
+    been seen as 0), a 1 byte point type and a big-endian value whose
+    length depends on the type.
+
+    Records are decoded as they are consumed; ValueError is raised on
+    reaching an unknown point type or truncated data.
+    """
+    # records are only a few bytes long, for which slicing bytes is
+    # cheaper than slicing a memoryview, so other buffers are copied once
+    if not isinstance(raw, bytes):
+        raw = bytes(raw)
+    lengths = POINT_TYPE_LENGTHS
+    from_bytes = int.from_bytes
+    size = len(raw)
+    pos = 0
+    while pos < size:
+        try:
+            end = pos + 3 + lengths[raw[pos + 2]]
+        except IndexError:
+            raise ValueError("Truncated point data") from None
+        except KeyError:
+            raise ValueError(
+                "Unknown point type: {}".format(raw[pos + 2])
+            ) from None
+        if end > size:
+            raise ValueError("Truncated point data")
+        yield (raw[pos] << 8 | raw[pos + 1], raw[pos + 2],
+               from_bytes(raw[pos + 3:end], 'big'))
+        pos = end
+
+
+def _decode_point_data_into(raw, values):
+    """
+    Decode binary pointData (bytes) into the dictionary values, as
+    iter_point_data but without building a record tuple per point
+    """
+    lengths = POINT_TYPE_LENGTHS
+    from_bytes = int.from_bytes
+    size = len(raw)
+    pos = 0
+    while pos < size:
+        try:
+            end = pos + 3 + lengths[raw[pos + 2]]
+        except IndexError:
+            raise ValueError("Truncated point data") from None
+        except KeyError:
+            raise ValueError(
+                "Unknown point type: {}".format(raw[pos + 2])
+            ) from None
+        if end > size:
+            raise ValueError("Truncated point data")
+        values[raw[pos] << 8 | raw[pos + 1]] = from_bytes(
+            raw[pos + 3:end], 'big'
+        )
+        pos = end
+    return values
+
 
-    return int_array
+def decode_point_data(raw):
+    """
+    Decode binary pointData into a dictionary
+    of point index (int) -> value (int)
+    """
+    if not isinstance(raw, bytes):
+        raw = bytes(raw)
+    return _decode_point_data_into(raw, {})
+
+
+def encode_point_data(records):
+    """
+    Encode (index, point type, value) records into binary pointData
+    """
+    out = bytearray()
+    for index, point_type, value in records:
+        if point_type not in POINT_TYPE_LENGTHS:
+            raise ValueError("Unknown point type: {}".format(point_type))
+        out += index.to_bytes(2, 'big')
+        out.append(point_type)
+        out += value.to_bytes(POINT_TYPE_LENGTHS[point_type], 'big')
+    return bytes(out)
+
+
+def point_data_to_values(pstr):
+    """
+    Decode base64-encoded MQTT pointData into a dictionary
+    of point index (int) -> value (int)
+    """
+    return _decode_point_data_into(binascii.a2b_base64(pstr), {})
+
+
+def point_data_to_values_batch(pstrs):
+    """
+    Decode many base64-encoded pointData strings, returning a list of
+    dictionaries as point_data_to_values. Pushes repeat a lot, so each
+    distinct string is only decoded once per batch.
+    """
+    decoded = {}
+    results = []
+    for pstr in pstrs:
+        values = decoded.get(pstr)
+        if values is None:
+            values = _decode_point_data_into(binascii.a2b_base64(pstr), {})
+            decoded[pstr] = values
+        results.append(dict(values))
+    return results
 
 
 def zone_is_active(zone):
@@ -129,45 +523,48 @@ def boiler_state(zone):
 
 def zone_is_scheduled_on(zone):
     """
-    Check if zone is scheduled to be on
+    Check if zone is scheduled to be on.
+    A Zone uses its compiled ZoneSchedule, for a plain dict only the
+    program of the current day is checked.
     """
     mode = zone_mode(zone)
     if mode == ZoneMode.OFF:
         return False
-
     if mode == ZoneMode.ON:
         return True
-
-    def scheduletime_to_time(stime):
-        """
-        Convert a schedule start/end time (an integer) to a Python time
-        For example, x = 173 is converted to 17:30
-        """
-        return datetime.time(int(str(stime)[:-1]), 10*int(str(stime)[-1:]))
+    if isinstance(zone, Zone):
+        return zone_schedule(zone).is_on(zone['timestamp']/1000, mode)
 
     tstamp = time.gmtime(zone['timestamp']/1000)
-    ts_time = datetime.time(tstamp.tm_hour, tstamp.tm_min)
-    ts_wday = tstamp.tm_wday + 1
-    if ts_wday == 7:
-        ts_wday = 0
-
+    minute = tstamp.tm_hour * 60 + tstamp.tm_min
+    day_type = (tstamp.tm_wday + 1) % 7
     for day in zone['deviceDays']:
-        if day['dayType'] == ts_wday:
-            if mode == ZoneMode.AUTO:
-                for period in ['p1', 'p2', 'p3']:
-                    start_time = scheduletime_to_time(day[period]['startTime'])
-                    end_time = scheduletime_to_time(day[period]['endTime'])
-                    if start_time <= ts_time <= end_time:
-                        return True
-            elif mode == ZoneMode.ALL_DAY:
-                start_time = scheduletime_to_time(day['p1']['startTime'])
-                end_time = scheduletime_to_time(day['p3']['endTime'])
-                if start_time <= ts_time <= end_time:
-                    return True
-
+        if day['dayType'] != day_type:
+            continue
+        if mode == ZoneMode.AUTO:
+            periods = [(day[period]['startTime'], day[period]['endTime'])
+                       for period in ('p1', 'p2', 'p3')]
+        else:
+            periods = [(day['p1']['startTime'], day['p3']['endTime'])]
+        for start, end in periods:
+            if (_schedule_minutes(start) <= minute
+                    <= _schedule_minutes(end)):
+                return True
     return False
 
 
+def zone_schedule(zone):
+    """
+    Get the compiled ZoneSchedule of a zone.
+    For a Zone it is compiled once and kept with the zone.
+    """
+    if isinstance(zone, Zone):
+        if zone.schedule is None:
+            zone.schedule = ZoneSchedule(zone['deviceDays'])
+        return zone.schedule
+    return ZoneSchedule(zone['deviceDays'])
+
+
 def zone_name(zone):
     """
     Get zone name
@@ -196,100 +593,1061 @@ def zone_boost_timestamp(zone):
     return zone_pointdata_value(zone, 'BOOST_TIME')
 
 
-def zone_temperature(zone, label):
+def zone_temperature(zone, label):
+    """
+    Return temperature (float) from the PointIndex value for label (str)
+    """
+    return zone_pointdata_value(zone, label)/10
+
+
+def zone_target_temperature(zone):
+    """
+    Get target temperature for this zone
+    """
+    return zone_temperature(zone, 'TARGET_TEMP')
+
+
+def zone_boost_temperature(zone):
+    """
+    Get target temperature for this zone
+    """
+    return zone_temperature(zone, 'BOOST_TEMP')
+
+
+def zone_current_temperature(zone):
+    """
+    Get current temperature for this zone
+    """
+    return zone_temperature(zone, 'CURRENT_TEMP')
+
+
+def zone_pointdata_value(zone, index):
+    """
+    Get value of given index for this zone, as an integer
+    index can be either an integer index, or a string label
+    from the PointIndex enum: 'ADVANCE_ACTIVE', 'CURRENT_TEMP', etc
+    """
+    index = _POINT_INDEX_VALUES.get(index, index)
+
+    if isinstance(zone, Zone):
+        return zone.point(index)
+
+    for datum in zone['pointDataList']:
+        if datum['pointIndex'] == index:
+            return int(datum['value'])
+
+    return None
+
+
+def zone_mode(zone):
+    """
+    Get mode for this zone
+    """
+    return ZoneMode(zone_pointdata_value(zone, 'MODE'))
+
+
+# """
+# Named tuple describing a change of a point value of a zone.
+# old is None for a point that was not known before,
+# new is None for a zone that is no longer present
+# """
+ZoneChange = collections.namedtuple(
+    'ZoneChange', ['mac', 'name', 'index', 'old', 'new']
+)
+
+
+def _point_index_value(field):
+    """
+    Integer point index of a PointIndex, its name, or an integer
+    """
+    if isinstance(field, PointIndex):
+        return field.value
+    return _POINT_INDEX_VALUES.get(field, field)
+
+
+def _diff_points(mac, name, old_points, new_points):
+    """
+    ZoneChange list between two point lists of a zone
+    """
+    if old_points == new_points:
+        return []
+    changes = []
+    for index in range(max(len(old_points), len(new_points))):
+        old = old_points[index] if index < len(old_points) else None
+        new = new_points[index] if index < len(new_points) else None
+        if old != new:
+            changes.append(ZoneChange(mac, name, index, old, new))
+    return changes
+
+
+def diff_zones(old_zones, new_zones):
+    """
+    List the point values that differ between two snapshots of zones.
+    Snapshots may be lists of zone dicts or Zone objects, or ZoneIndex.
+    """
+    if not isinstance(old_zones, ZoneIndex):
+        old_zones = ZoneIndex(old_zones)
+    if not isinstance(new_zones, ZoneIndex):
+        new_zones = ZoneIndex(new_zones)
+
+    changes = []
+    for mac, zone in new_zones.by_mac.items():
+        previous = old_zones.by_mac.get(mac)
+        changes.extend(_diff_points(
+            mac, zone['name'],
+            previous.points if previous is not None else [], zone.points
+        ))
+    for mac, zone in old_zones.by_mac.items():
+        if mac not in new_zones.by_mac:
+            changes.extend(_diff_points(mac, zone['name'], zone.points, []))
+    return changes
+
+
+class ZoneWatcher:
+    """
+    Keeps the last known point values of zones and calls subscribers
+    with the changes when new snapshots or pushed point data arrive.
+
+    Example usage: watcher = ZoneWatcher()
+                   watcher.subscribe(on_temp, fields=['CURRENT_TEMP'])
+                   watcher.update(t.get_zones(), notify=False)
+                   t.start_live_updates(on_pointdata=watcher.apply_pointdata)
+    """
+
+    def _dispatch(self, changes):
+        """
+        Call each subscriber with the changes matching its filters
+        """
+        if not changes:
+            return
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback, indices, macs in subscribers:
+            matching = [
+                change for change in changes
+                if (indices is None or change.index in indices)
+                and (macs is None or change.mac in macs)
+            ]
+            if matching:
+                callback(matching)
+
+    # Public interface
+
+    def subscribe(self, callback, fields=None, macs=None):
+        """
+        Call callback(changes) with the list of ZoneChange of each update
+        that touches one of fields (PointIndex, names or integer indices)
+        of one of the zones in macs. None means any field or any zone.
+        """
+        indices = None
+        if fields is not None:
+            indices = frozenset(_point_index_value(field) for field in fields)
+        if macs is not None:
+            macs = frozenset(macs)
+        with self._lock:
+            self._subscribers.append((callback, indices, macs))
+
+    def unsubscribe(self, callback):
+        """
+        Remove all subscriptions of callback
+        """
+        with self._lock:
+            self._subscribers = [
+                subscriber for subscriber in self._subscribers
+                if subscriber[0] != callback
+            ]
+
+    def update(self, zones, notify=True):
+        """
+        Compare a snapshot of zones with the known state, store it and
+        return the list of ZoneChange. Subscribers are called unless
+        notify is False (e.g. when seeding the state).
+        """
+        if not isinstance(zones, ZoneIndex):
+            zones = ZoneIndex(zones)
+        changes = []
+        with self._lock:
+            for mac, zone in zones.by_mac.items():
+                changes.extend(_diff_points(
+                    mac, zone['name'], self._points.get(mac, []),
+                    zone.points
+                ))
+                self._points[mac] = list(zone.points)
+                self._names[mac] = zone['name']
+            for mac in list(self._points):
+                if mac not in zones.by_mac:
+                    changes.extend(_diff_points(
+                        mac, self._names.pop(mac), self._points.pop(mac), []
+                    ))
+        if notify:
+            self._dispatch(changes)
+        return changes
+
+    def apply_pointdata(self, mac, values):
+        """
+        Apply pushed point data {point index: value} of a zone and return
+        the list of ZoneChange. The signature matches
+        EphMessenger.subscribe_pointdata callbacks.
+        """
+        changes = []
+        with self._lock:
+            points = self._points.get(mac)
+            if points is None:
+                return changes
+            for index, value in values.items():
+                if index >= len(points):
+                    points.extend([None] * (index + 1 - len(points)))
+                if points[index] != value:
+                    changes.append(ZoneChange(
+                        mac, self._names[mac], index, points[index], value
+                    ))
+                    points[index] = value
+        self._dispatch(changes)
+        return changes
+
+    def value(self, mac, field):
+        """
+        Last known value of a field of a zone, or None
+        """
+        index = _point_index_value(field)
+        with self._lock:
+            points = self._points.get(mac, [])
+            return points[index] if index < len(points) else None
+
+    def __init__(self):
+        # mac -> list of point values indexed by point index
+        self._points = {}
+        self._names = {}
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+
+def zone_boost_commands(boost_temperature, num_hours, timestamp=0):
+    """
+    List of ZoneCommand setting a boost of num_hours (0 turns it off).
+
+    If boost_temperature is not None, send that
+
+    If timestamp is 0 (or omitted), use current timestamp
+
+    If timestamp is None, do not send timestamp at all.
+    """
+    cmds = [ZoneCommand('BOOST_HOURS', num_hours)]
+    if boost_temperature is not None:
+        cmds.append(ZoneCommand('BOOST_TEMP', boost_temperature))
+    if timestamp is not None:
+        if timestamp == 0:
+            timestamp = int(datetime.datetime.now().timestamp())
+        cmds.append(ZoneCommand('BOOST_TIME', timestamp))
+    return cmds
+
+
+class ZoneBatch:
+    """
+    Collects commands for many zones and sends them together.
+    Example usage: batch = t.batch()
+                   batch.set_target_temperature('kitchen', 20)
+                   batch.set_mode('hall', ZoneMode.OFF)
+                   results = batch.commit()
+
+    A later command for the same value of a zone replaces the earlier one.
+    Nothing is sent until commit().
+    """
+
+    def __init__(self, ember):
+        self._ember = ember
+        # zone name -> {command name: ZoneCommand}, in order of first use
+        self._commands = {}
+
+    def __len__(self):
+        return len(self._commands)
+
+    def add(self, name, commands):
+        """
+        Add a ZoneCommand, or a list of them, for the named zone
+        """
+        if isinstance(commands, ZoneCommand):
+            commands = [commands]
+        zone_commands = self._commands.setdefault(name, {})
+        for command in commands:
+            # validate now, not halfway through commit
+            zone_command_to_ints(command)
+            zone_commands[command.name] = command
+        return self
+
+    def set_target_temperature(self, name, target_temperature):
+        """
+        Set the target temperature for a named zone
+        """
+        return self.add(name, ZoneCommand('TARGET_TEMP', target_temperature))
+
+    def set_boost_temperature(self, name, target_temperature):
+        """
+        Set the boost target temperature for a named zone
+        """
+        return self.add(name, ZoneCommand('BOOST_TEMP', target_temperature))
+
+    def set_advance(self, name, advance_state=True):
+        """
+        Set the advance state for a named zone
+        """
+        return self.add(
+            name, ZoneCommand('ADVANCE_ACTIVE', 1 if advance_state else 0)
+        )
+
+    def set_mode(self, name, mode):
+        """
+        Set the mode of a named zone, a ZoneMode or its value
+        """
+        if isinstance(mode, int):
+            mode = ZoneMode(mode)
+
+        assert isinstance(mode, ZoneMode)
+
+        return self.add(name, ZoneCommand('MODE', mode.value))
+
+    def activate_boost(self, name, boost_temperature=None,
+                       num_hours=1, timestamp=0):
+        """
+        Turn on boost for a named zone, replacing any boost
+        change already in the batch for it
+        """
+        zone_commands = self._commands.get(name, {})
+        for command_name in ('BOOST_HOURS', 'BOOST_TEMP', 'BOOST_TIME'):
+            zone_commands.pop(command_name, None)
+        return self.add(
+            name, zone_boost_commands(boost_temperature, num_hours, timestamp)
+        )
+
+    def deactivate_boost(self, name):
+        """
+        Turn off boost for a named zone
+        """
+        return self.activate_boost(name, num_hours=0, timestamp=None)
+
+    def commit(self, timeout=1, wait=False):
+        """
+        Send all collected commands, one message per zone over a single
+        connection, and empty the batch.
+
+        Returns {zone name: True if its message was published}, or with
+        wait=True {zone name: True if the zone reported the new values
+        within timeout}.
+        Raises RuntimeError before sending anything if a zone is unknown.
+        """
+        index = self._ember.get_zone_index()
+        by_mac = {}
+        names = {}
+        for name, commands in self._commands.items():
+            zone = index.get_zone(name)
+            merged = by_mac.setdefault(zone['mac'], (zone, {}))[1]
+            merged.update(commands)
+            names.setdefault(zone['mac'], []).append(name)
+
+        results = self._ember.messenger.send_zone_commands_batch(
+            [(zone, list(commands.values()))
+             for zone, commands in by_mac.values()],
+            timeout=timeout, confirm=wait
+        )
+        self._commands = {}
+        self._ember.invalidate_home_cache()
+
+        return {
+            name: result
+            for mac, result in zip(by_mac, results)
+            for name in names[mac]
+        }
+
+
+def _user_details(username, password):
+    """
+    The user of a client, whose id is looked up on first use
+    """
+    return {
+        'user_id': None,
+        'username': username,
+        'password': password
+    }
+
+
+def _login_data_from_response(login_data):
+    """
+    Check an appLogin/login response and return it as login data,
+    stamped with the time of the login, or None if it has no token
+    """
+    if (login_data.get('status') != 0
+            or 'token' not in login_data.get('data', {})):
+        return None
+    login_data["last_refresh"] = datetime.datetime.utcnow()
+    return login_data
+
+
+def _refresh_login_data(login_data, refresh_data):
+    """
+    Update login data from an appLogin/refreshAccessToken response.
+    Returns False if the response has no token.
+    """
+    if 'token' not in refresh_data.get('data', {}):
+        return False
+    login_data['data'] = refresh_data['data']
+    login_data['last_refresh'] = datetime.datetime.utcnow()
+    return True
+
+
+def _token_expires_in(login_data, validity_seconds):
+    """
+    Seconds until the token of login data expires
+    """
+    expires_on = login_data["last_refresh"] + \
+        datetime.timedelta(seconds=validity_seconds)
+    return (expires_on - datetime.datetime.utcnow()).total_seconds()
+
+
+def _homes_from_response(homes):
+    """
+    Check a homes/list response and return the list of homes
+    """
+    status = homes.get('status', 1)
+    if status != 0:
+        raise RuntimeError("Error getting home: {}".format(status))
+
+    return homes.get("data", [])
+
+
+def _home_details_from_response(home_details):
+    """
+    Check a homes/detail response and return its data
+    """
+    status = home_details.get('status', 1)
+    if status != 0:
+        raise RuntimeError(
+            "Error getting details from home: {}".format(status))
+
+    if "data" not in home_details or "homes" not in home_details["data"]:
+        raise RuntimeError(
+            "Error getting details from home: no home data found")
+
+    return home_details["data"]
+
+
+def _zones_from_response(home):
+    """
+    Check a homesVT/zoneProgram response and return its zones,
+    each stamped with the response timestamp
+    """
+    status = home.get('status', 1)
+    if status != 0:
+        raise RuntimeError(
+            "Error getting zones from home: {}".format(status))
+
+    if "data" not in home:
+        raise RuntimeError(
+            "Error getting zones from home: no data found")
+    if "timestamp" not in home:
+        raise RuntimeError(
+            "Error getting zones from home: no timestamp found")
+
+    for zone in home["data"]:
+        zone["timestamp"] = home["timestamp"]
+
+    return home["data"]
+
+
+def _zone_from_response(response, missing_ok=False):
+    """
+    Check a homesVT/zoneViewProgram response and return its zone,
+    stamped with the response timestamp. With missing_ok, a response
+    without the zone (e.g. it was removed) returns None.
+    """
+    status = response.get('status', 1)
+    if status != 0:
+        if missing_ok:
+            return None
+        raise RuntimeError(
+            "Error getting zone: {}".format(status))
+
+    if not response.get("data"):
+        if missing_ok:
+            return None
+        raise RuntimeError(
+            "Error getting zone: no data found")
+    if "timestamp" not in response:
+        raise RuntimeError(
+            "Error getting zone: no timestamp found")
+
+    response["data"]["timestamp"] = response["timestamp"]
+    return response["data"]
+
+
+def zone_commands_to_bytes(commands):
+    """
+    Bundle a ZoneCommand, or a list of them, into binary pointData
+    """
+    if isinstance(commands, ZoneCommand):
+        commands = [commands]
+
+    return b"".join(_zone_command_bytes(cmd) for cmd in commands)
+
+
+def zone_commands_to_b64(commands):
+    """
+    Bundle a ZoneCommand, or a list of them, into the base64
+    pointData string sent over MQTT
+    """
+    return base64.b64encode(zone_commands_to_bytes(commands)).decode("ascii")
+
+
+def _publish_context_for(context, home_details):
+    """
+    The _PublishContext of a home: context if it was built from
+    home_details, else a new one
+    """
+    if context is None or context.home_details is not home_details:
+        context = _PublishContext(home_details)
+    return context
+
+
+class _PublishContext:
+    """
+    Point data topics and command message envelope of a home,
+    built once from its details and reused for every command
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('home_details', 'upload_topic', 'download_topic',
+                 '_head', '_tail')
+
+    SERIAL = 7870
+
+    def __init__(self, home_details):
+        home = home_details['homes']
+        self.home_details = home_details
+        base = "/".join([home['productId'], home['uid']])
+        self.upload_topic = base + "/upload/pointdata"
+        self.download_topic = base + "/download/pointdata"
+
+        # same text as json.dumps of the whole message
+        common = json.dumps({
+            "serial": self.SERIAL,
+            "productId": home['productId'],
+            "uid": home['uid']
+        })
+        self._head = '{"common": ' + common[:-1] + ', "timestamp": "'
+        self._tail = '"}, "data": {"mac": '
+
+    def message(self, mac, cmd):
+        """
+        JSON message publishing the base64 command cmd to the zone mac
+        """
+        return ''.join((
+            self._head, str(int(1000*time.time())), self._tail,
+            json.dumps(mac), ', "pointData": "', cmd, '"}}'
+        ))
+
+
+def _pointdata_message_values(payload):
+    """
+    Decode a raw upload/pointdata MQTT payload into (mac, values),
+    or None if it carries no point data
+    """
+    return pointdata_messages_to_values([payload])[0]
+
+
+def pointdata_messages_to_values(payloads):
+    """
+    Decode many raw upload/pointdata MQTT payloads, returning for each
+    (mac, values) or None if it carries no point data.
+    """
+    decoded = {}
+    results = []
+    for payload in payloads:
+        data = json.loads(payload.decode("utf-8").rstrip('\0')).get('data')
+        if not data or 'mac' not in data or 'pointData' not in data:
+            results.append(None)
+            continue
+        pstr = data['pointData']
+        values = decoded.get(pstr)
+        if values is None:
+            values = _decode_point_data_into(binascii.a2b_base64(pstr), {})
+            decoded[pstr] = values
+        results.append((data['mac'], dict(values)))
+    return results
+
+
+class _SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in
+    flight, other callers for that key wait for and share its result
+    """
+    # do() is the whole interface
+    # pylint: disable=too-few-public-methods
+
+    class _Call:
+        # pylint: disable=too-few-public-methods
+        __slots__ = ('done', 'result', 'error')
+
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Return func(), or the result of the call of func already
+        in flight for key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
+class _PendingAck:
+    """
+    A sent command waiting for the zone to report the written values
+    """
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('mac', 'remaining', 'confirmed')
+
+    def __init__(self, mac, expected):
+        self.mac = mac
+        # point index -> value not yet seen in an upload/pointdata push
+        self.remaining = dict(expected)
+        self.confirmed = threading.Event()
+
+    def match(self, values):
+        """
+        Tick off the expected values present in pushed point data
+        """
+        for index, value in values.items():
+            if self.remaining.get(index) == value:
+                del self.remaining[index]
+        if not self.remaining:
+            self.confirmed.set()
+
+
+# HTTP statuses retried with backoff, by the session or by EphEmber._send
+_RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class RateLimiter:
     """
-    Return temperature (float) from the PointIndex value for label (str)
+    Token bucket allowing rate requests per second, in bursts of up to
+    burst requests. One limiter can be shared by many EphEmber clients
+    to limit them together.
+
+    The rate adapts to the server: every error halves it, down to
+    min_rate, and delays the next request by a random part of an
+    exponential backoff; every success raises it again by a twentieth
+    of the configured rate.
     """
-    return zone_pointdata_value(zone, label)/10
 
+    # pylint: disable=too-many-instance-attributes
 
-def zone_target_temperature(zone):
-    """
-    Get target temperature for this zone
-    """
-    return zone_temperature(zone, 'TARGET_TEMP')
+    # weight of the latest request in error_rate
+    ERROR_RATE_WEIGHT = 0.05
 
+    def _refill(self, now):
+        """
+        Add the tokens earned since the last update
+        """
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
 
-def zone_boost_temperature(zone):
-    """
-    Get target temperature for this zone
-    """
-    return zone_temperature(zone, 'BOOST_TEMP')
+    # Public interface
 
+    @property
+    def rate(self):
+        """
+        Current allowed requests per second
+        """
+        return self._rate
 
-def zone_current_temperature(zone):
-    """
-    Get current temperature for this zone
-    """
-    return zone_temperature(zone, 'CURRENT_TEMP')
+    @property
+    def error_rate(self):
+        """
+        Moving average of the fraction of requests that failed
+        """
+        return self._error_rate
 
+    def acquire(self):
+        """
+        Wait until a request may be sent.
+        Returns the number of seconds waited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # tokens may go negative: later callers queue behind this one
+            self._tokens -= 1
+            delay = max(
+                -self._tokens / self._rate if self._tokens < 0 else 0,
+                self._not_before - now
+            )
+        if delay > 0:
+            time.sleep(delay)
+        return max(delay, 0)
 
-def zone_pointdata_value(zone, index):
-    """
-    Get value of given index for this zone, as an integer
-    index can be either an integer index, or a string label
-    from the PointIndex enum: 'ADVANCE_ACTIVE', 'CURRENT_TEMP', etc
-    """
-    # pylint: disable=unsubscriptable-object
-    if hasattr(PointIndex, index):
-        index = PointIndex[index].value
+    def success(self):
+        """
+        Record a request the server handled
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._failures = 0
+            self._error_rate *= 1 - self.ERROR_RATE_WEIGHT
+            self._rate = min(self.max_rate, self._rate + self.max_rate / 20)
 
-    for datum in zone['pointDataList']:
-        if datum['pointIndex'] == index:
-            return int(datum['value'])
+    def failure(self):
+        """
+        Record a request that failed or was throttled by the server
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._failures += 1
+            self._error_rate += (
+                self.ERROR_RATE_WEIGHT * (1 - self._error_rate)
+            )
+            self._rate = max(self.min_rate, self._rate / 2)
+            backoff = min(
+                self.max_backoff, self.backoff * 2 ** (self._failures - 1)
+            )
+            self._not_before = max(
+                self._not_before, now + random.uniform(0, backoff)
+            )
 
-    return None
+    # pylint: disable=too-many-arguments
+    def __init__(self, rate, burst=None, min_rate=None, backoff=0.5,
+                 max_backoff=30):
+        self.max_rate = float(rate)
+        self.burst = burst if burst is not None else max(1.0, self.max_rate)
+        self.min_rate = (
+            min_rate if min_rate is not None else self.max_rate / 16
+        )
+        self.backoff = backoff
+        self.max_backoff = max_backoff
 
+        self._rate = self.max_rate
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        # no request is sent before this time on the monotonic clock
+        self._not_before = 0.0
+        self._failures = 0
+        self._error_rate = 0.0
+        self._lock = threading.Lock()
 
-def zone_mode(zone):
+
+class _QueuedPublish:
     """
-    Get mode for this zone
+    A message waiting in the EphMessenger outbox. sent is set once it
+    leaves the outbox, with info None if it was dropped unpublished.
     """
-    return ZoneMode(zone_pointdata_value(zone, 'MODE'))
+    # pylint: disable=too-few-public-methods
+    __slots__ = ('topic', 'payload', 'info', 'sent')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.info = None
+        self.sent = threading.Event()
 
 
 class EphMessenger:
     """
     MQTT interface to the EphEmber API
+
+    With persistent=True a single connection is kept open by a background
+    loop that reconnects automatically, and commands are published from a
+    thread-safe outbox instead of connecting once per command.
     """
 
+    # pylint: disable=too-many-instance-attributes
+
+    def _publish_context(self):
+        """
+        Get the publish context of the home, rebuilt only
+        when the home details change
+        """
+        self._context = _publish_context_for(
+            self._context, self.parent.get_home_details()
+        )
+        return self._context
+
+    def _pointdata_topic(self, direction):
+        """
+        Topic for point data messages of the home,
+        direction should be "upload" or "download"
+        """
+        context = self._publish_context()
+        if direction == "upload":
+            return context.upload_topic
+        return context.download_topic
+
+    # pylint: disable=unused-argument
+
+    def _on_connect(self, client, userdata, flags, result_code):
+        """
+        Restore subscriptions and send anything queued while disconnected.
+        After a reconnect, pushes may have been missed, so have the
+        parent resync its live state (off the loop thread, as it does
+        HTTP requests).
+        """
+        if result_code != 0:
+            return
+        for topic in self._handlers:
+            client.subscribe(topic, 0)
+        self._flush_outbox()
+        reconnect = self._connected_before
+        self._connected_before = True
+        if reconnect:
+            threading.Thread(
+                # pylint: disable=protected-access
+                target=self.parent._resync_live, daemon=True
+            ).start()
+
+    def _on_disconnect(self, client, userdata, result_code):
+        """
+        The token may have expired while connected, so make sure
+        the automatic reconnect uses fresh credentials
+        """
+        if result_code != 0 and self._loop_running:
+            try:
+                token = self.parent.messenging_credentials()['token']
+            except (RuntimeError, OSError):  # RequestException is an OSError
+                # keep the old credentials, the next attempt retries
+                return
+            client.username_pw_set("app/{}".format(token), token)
+
+    def _on_pointdata(self, message):
+        """
+        Handle an upload/pointdata push: confirm pending commands,
+        then pass it on to the subscribe_pointdata callback of its home
+        """
+        # this runs on the paho loop thread, which an exception would kill
+        try:
+            decoded = _pointdata_message_values(message.payload)
+        except (ValueError, TypeError, AttributeError):
+            _LOGGER.warning("Dropping malformed push on %s", message.topic)
+            return
+        if decoded is None:
+            return
+        mac, values = decoded
+        with self._acks_lock:
+            for ack in self._pending_acks.get(mac, ()):
+                ack.match(values)
+            callback = self._pointdata_callbacks.get(message.topic)
+        if callback is not None:
+            try:
+                callback(mac, values)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Point data callback failed")
+
+    def _on_message(self, client, userdata, message):
+        """
+        Dispatch a message to the handler registered for its topic
+        """
+        handler = self._handlers.get(message.topic)
+        if handler is not None:
+            handler(message)
+
+    # pylint: enable=unused-argument
+
+    def _flush_outbox(self):
+        """
+        Publish queued messages, in order, while the client is connected
+        """
+        with self._outbox_lock:
+            while self._outbox and self.client.is_connected():
+                item = self._outbox[0]
+                info = self.client.publish(item.topic, item.payload, 0)
+                if info.rc != _mqtt().MQTT_ERR_SUCCESS:
+                    break
+                self._outbox.popleft()
+                item.info = info
+                item.sent.set()
+
+    def _ensure_loop(self):
+        """
+        Start the long-lived background connection if it is not running
+        """
+        with self._start_lock:
+            if self._loop_running:
+                return
+            self.prepare()
+            self.start(loop_start=True)
+            self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+            self._loop_running = True
+
+    def _enqueue(self, topic, payloads, timeout):
+        """
+        Queue messages for the background connection.
+        With timeout 0 return as soon as the messages are queued,
+        otherwise wait up to timeout seconds for them to be published.
+        """
+        items = [_QueuedPublish(topic, payload) for payload in payloads]
+        self._ensure_loop()
+        with self._outbox_lock:
+            self._outbox.extend(items)
+        self._flush_outbox()
+
+        if not timeout:
+            return [True] * len(items)
+        deadline = time.monotonic() + timeout
+        results = []
+        for item in items:
+            if not item.sent.wait(max(0, deadline - time.monotonic())):
+                # timed out: don't publish it later behind the caller's back
+                with self._outbox_lock:
+                    if not item.sent.is_set():
+                        self._outbox.remove(item)
+                        item.sent.set()
+            if item.info is None:
+                results.append(False)
+                continue
+            item.info.wait_for_publish(
+                timeout=max(0, deadline - time.monotonic())
+            )
+            results.append(item.info.is_published())
+        return results
+
+    def _publish_all(self, payloads, stop_mqtt=True, timeout=1):
+        """
+        Publish messages to the download/pointdata topic over a single
+        connection. Returns, for each message, whether it was published
+        within the timeout.
+        """
+        topic = self._pointdata_topic("download")
+
+        if self.persistent or self._loop_running:
+            return self._enqueue(topic, payloads, timeout)
+
+        # one short-lived connection at a time
+        with self._start_lock:
+            started_locally = False
+            if not self.client or not self.client.is_connected():
+                started_locally = True
+                self.start()
+
+            pubs = [self.client.publish(topic, msg, 0) for msg in payloads]
+            deadline = time.monotonic() + timeout
+            for pub in pubs:
+                pub.wait_for_publish(
+                    timeout=max(0, deadline - time.monotonic())
+                )
+
+            if started_locally and stop_mqtt:
+                self.stop()
+
+        return [pub.is_published() for pub in pubs]
+
+    def _watch_upload(self, topic=None):
+        """
+        Make sure an upload/pointdata topic, by default the home's,
+        is subscribed on the background connection
+        """
+        if topic is None:
+            topic = self._pointdata_topic("upload")
+        # _start_lock keeps _unwatch_upload from stopping the loop
+        # between adding the handler and subscribing
+        with self._start_lock:
+            with self._acks_lock:
+                if topic in self._handlers:
+                    return
+                self._handlers[topic] = self._on_pointdata
+            if self._loop_running:
+                self.client.subscribe(topic, 0)
+            else:
+                # _on_connect subscribes once the connection is up
+                self._ensure_loop()
+
+    def _unwatch_upload(self, topic=None):
+        """
+        Drop an upload/pointdata subscription, by default the home's,
+        once neither a callback nor a pending command needs it.
+        The connection is closed unless the messenger is persistent.
+        """
+        home_topic = self._pointdata_topic("upload")
+        if topic is None:
+            topic = home_topic
+        with self._start_lock:
+            with self._acks_lock:
+                if topic in self._pointdata_callbacks:
+                    return
+                if topic == home_topic and self._pending_acks:
+                    return
+                if self._handlers.pop(topic, None) is None:
+                    return
+                idle = not self.persistent and not self._handlers
+            # not under _acks_lock: stopping joins the loop thread,
+            # which takes it in _on_pointdata
+            if idle:
+                self.stop()
+            elif self._loop_running:
+                self.client.unsubscribe(topic)
+
+    def _publish_confirmed(self, messages, timeout):
+        """
+        Publish (mac, payload, expected values) messages and wait up to
+        timeout seconds for each zone to push point data containing its
+        expected values. Returns, for each message, whether it was
+        confirmed.
+        """
+        acks = [_PendingAck(mac, expected) for mac, _, expected in messages]
+        with self._acks_lock:
+            for ack in acks:
+                self._pending_acks.setdefault(ack.mac, []).append(ack)
+        try:
+            # subscribe before publishing so the echo can't be missed
+            self._watch_upload()
+            deadline = time.monotonic() + timeout
+            self._publish_all(
+                [payload for _, payload, _ in messages], timeout=timeout
+            )
+            return [
+                ack.confirmed.wait(max(0, deadline - time.monotonic()))
+                for ack in acks
+            ]
+        finally:
+            with self._acks_lock:
+                for ack in acks:
+                    pending = self._pending_acks[ack.mac]
+                    pending.remove(ack)
+                    if not pending:
+                        del self._pending_acks[ack.mac]
+            self._unwatch_upload()
+
     def _zone_command_b64(self, zone, cmd, stop_mqtt=True, timeout=1):
         """
         Send a base64-encoded MQTT command to a zone
         Returns true if the command was published within the timeout
         """
-        product_id = self.parent.get_home_details()['homes']['productId']
-        uid = self.parent.get_home_details()['homes']['uid']
-
-        msg = json.dumps(
-            {
-                "common": {
-                    "serial": 7870,
-                    "productId": product_id,
-                    "uid": uid,
-                    "timestamp": str(int(1000*time.time()))
-                },
-                "data": {
-                    "mac": zone['mac'],
-                    "pointData": cmd
-                }
-            }
-        )
-
-        started_locally = False
-        if not self.client or not self.client.is_connected():
-            started_locally = True
-            self.start()
-
-        pub = self.client.publish(
-            "/".join([product_id, uid, "download/pointdata"]), msg, 0
-        )
-        pub.wait_for_publish(timeout=timeout)
-
-        if started_locally and stop_mqtt:
-            self.stop()
-
-        return pub.is_published()
+        msg = self._publish_context().message(zone['mac'], cmd)
+        return self._publish_all([msg], stop_mqtt, timeout)[0]
 
     # Public interface
 
@@ -303,13 +1661,18 @@ class EphMessenger:
         )
         token = credentials['token']
 
-        mclient = mqtt.Client(self.client_id)
-        mclient.tls_set()
+        mclient = _mqtt().Client(self.client_id)
+        if self.use_tls:
+            mclient.tls_set()
         self.client = mclient
+        self._connected_before = False
 
         user_name = "app/{}".format(token)
         mclient.username_pw_set(user_name, token)
 
+        mclient.on_connect = self._on_connect
+        mclient.on_disconnect = self._on_disconnect
+        mclient.on_message = self._on_message
         if callbacks is not None:
             for key in callbacks.keys():
                 setattr(mclient, key, callbacks[key])
@@ -323,15 +1686,60 @@ class EphMessenger:
 
     def stop(self):
         """
-        Disconnect MQTT client if connected
+        Disconnect MQTT client if connected.
+        Messages still in the outbox are dropped and reported unpublished.
         """
+        with self._outbox_lock:
+            while self._outbox:
+                self._outbox.popleft().sent.set()
         if not self.client:
             return False
+        running = self._loop_running
+        self._loop_running = False
         if self.client.is_connected():
             self.client.disconnect()
+        if running:
+            self.client.loop_stop()
         return True
 
-    def send_zone_commands(self, zone, commands, stop_mqtt=True, timeout=1):
+    def subscribe_pointdata(self, on_pointdata, home_details=None):
+        """
+        Subscribe to the upload/pointdata topic of the home on the
+        background connection.
+
+        on_pointdata(mac, values) is called for every pushed message,
+        with values a dictionary of point index -> integer value.
+
+        To receive the pushes of another home of the account on the
+        same connection, pass its home_details (see get_home_details).
+        Each home has one on_pointdata, replaced by later calls.
+        """
+        if home_details is None:
+            topic = self._pointdata_topic("upload")
+        else:
+            topic = _PublishContext(home_details).upload_topic
+        with self._acks_lock:
+            self._pointdata_callbacks[topic] = on_pointdata
+        self._watch_upload(topic)
+        return self.client
+
+    def unsubscribe_pointdata(self, home_details=None):
+        """
+        Stop receiving upload/pointdata messages, of the home
+        or of the home of the given home_details.
+        The connection is closed unless the messenger is persistent
+        or still needed.
+        """
+        if home_details is None:
+            topic = self._pointdata_topic("upload")
+        else:
+            topic = _PublishContext(home_details).upload_topic
+        with self._acks_lock:
+            self._pointdata_callbacks.pop(topic, None)
+        self._unwatch_upload(topic)
+
+    def send_zone_commands(self, zone, commands, stop_mqtt=True, timeout=1,
+                           confirm=False):
         """
         Bundles the given array of ZoneCommand objects
         to a single MQTT command and sends to the named zone.
@@ -339,64 +1747,123 @@ class EphMessenger:
         If a single ZoneCommand is given, send just that.
 
         Returns true if the bundled command was published within the timeout.
+        On a persistent connection a timeout of 0 returns as soon as the
+        command is queued.
+
+        With confirm=True, wait instead until the zone pushes point data
+        showing the written values, and return true if it did so within
+        the timeout.
 
         For example, to set target temperature to 19:
 
           send_zone_command("Zone_name", ZoneCommand('TARGET_TEMP', 19))
 
         """
-        def ints_to_b64_cmd(int_array):
-            """
-            Convert an array of integers to a byte array and
-            return its base64 string in ascii
-            """
-            return base64.b64encode(bytes(int_array)).decode("ascii")
-
-        if isinstance(commands, ZoneCommand):
-            commands = [commands]
-
-        ints_cmd = [
-            x for cmd in commands
-            for x in zone_command_to_ints(cmd)
-        ]
-
+        if confirm:
+            return self.send_zone_commands_batch(
+                [(zone, commands)], timeout=timeout, confirm=True
+            )[0]
         return self._zone_command_b64(
-            zone, ints_to_b64_cmd(ints_cmd), stop_mqtt, timeout
+            zone, zone_commands_to_b64(commands), stop_mqtt, timeout
         )
 
-    def __init__(self, parent):
+    def prepare(self):
+        """
+        Fetch the home details and build the publish context now,
+        so that the first command does not wait for them
+        """
+        self._publish_context()
+
+    def send_zone_commands_batch(self, zone_commands, stop_mqtt=True,
+                                 timeout=1, confirm=False):
+        """
+        Send several zones their commands over one connection.
+        zone_commands is a list of (zone, commands) pairs, with commands
+        a ZoneCommand or a list of them.
+
+        Returns a list with, for each zone, whether its command was
+        published within the timeout, or with confirm=True whether the
+        zone confirmed it (see send_zone_commands).
+        """
+        context = self._publish_context()
+        if confirm:
+            messages = []
+            for zone, commands in zone_commands:
+                raw = zone_commands_to_bytes(commands)
+                messages.append((
+                    zone['mac'],
+                    context.message(
+                        zone['mac'], base64.b64encode(raw).decode("ascii")
+                    ),
+                    decode_point_data(raw)
+                ))
+            if not messages:
+                return []
+            return self._publish_confirmed(messages, timeout)
+        payloads = [
+            context.message(zone['mac'], zone_commands_to_b64(commands))
+            for zone, commands in zone_commands
+        ]
+        if not payloads:
+            return []
+        return self._publish_all(payloads, stop_mqtt, timeout)
+
+    def __init__(self, parent, persistent=False):
 
         self.api_url = 'eu-base-mqtt.topband-cloud.com'
         self.api_port = 18883
+        # plain TCP is only useful against a local test broker
+        self.use_tls = True
 
         self.client = None
         self.client_id = None
 
         self.parent = parent
 
+        self.persistent = persistent
+        self._loop_running = False
+        # whether the current client connected before, see _on_connect
+        self._connected_before = False
+        # topic -> handler(message) for subscriptions on the connection
+        self._handlers = {}
+        # upload topic -> on_pointdata of subscribe_pointdata,
+        # and mac -> [_PendingAck]
+        self._pointdata_callbacks = {}
+        self._pending_acks = {}
+        self._acks_lock = threading.Lock()
+        self._outbox = collections.deque()
+        self._outbox_lock = threading.Lock()
+        # _PublishContext of the home, see _publish_context
+        self._context = None
+        # reentrant: _watch_upload holds it around _ensure_loop
+        self._start_lock = threading.RLock()
+
 
 class EphEmber:
     """
     Interacts with a EphEmber thermostat via API.
+    An instance can be shared between threads; concurrent identical
+    reads (list_homes, get_home, get_home_details) share one request.
     Example usage: t = EphEmber('me@somewhere.com', 'mypasswd')
                    t.get_zone_temperature('myzone') # Get temperature
     """
 
     # pylint: disable=too-many-public-methods
+    # the caches, live state, token refresher and session each keep
+    # their own attributes and locks
+    # pylint: disable=too-many-instance-attributes
 
-    def _http(self, endpoint, *, method=requests.post, headers=None,
+    def _http(self, endpoint, *, method="POST", headers=None,
               send_token=False, data=None, timeout=10):
         """
         Send a request to the http API endpoint
-        method should be requests.get or requests.post
+        method should be "GET" or "POST"
         """
         if not headers:
             headers = {}
 
         if send_token:
-            if not self._do_auth():
-                raise RuntimeError("Unable to login")
-            headers["Authorization"] = self._login_data["data"]["token"]
+            headers["Authorization"] = self._auth_token()
 
         headers["Content-Type"] = "application/json"
         headers["Accept"] = "application/json"
@@ -406,7 +1873,13 @@ class EphEmber:
         if data and isinstance(data, dict):
             data = json.dumps(data)
 
-        response = method(url, data=data, headers=headers, timeout=timeout)
+        response = self._send(method, url, data, headers, timeout)
+
+        if send_token and response.status_code == 401:
+            # token rejected: renew it once and retry
+            self._renew_rejected_token(headers["Authorization"])
+            headers["Authorization"] = self._auth_token()
+            response = self._send(method, url, data, headers, timeout)
 
         if response.status_code != 200:
             raise RuntimeError(
@@ -415,14 +1888,64 @@ class EphEmber:
 
         return response
 
+    def _send(self, method, url, data, headers, timeout):
+        """
+        Send a request once the rate limiters allow it, and report to
+        them whether the server handled it. With rate limiters, 5xx
+        responses are retried here rather than by the session, so that
+        each retry waits for the limiters and counts as a failure.
+        """
+        attempts = 1 + (self._retries if self._rate_limiters else 0)
+        for attempt in range(attempts):
+            for limiter in self._rate_limiters:
+                limiter.acquire()
+            try:
+                response = self._http_session().request(
+                    method, url, data=data, headers=headers, timeout=timeout
+                )
+            except OSError:  # RequestException is an OSError
+                for limiter in self._rate_limiters:
+                    limiter.failure()
+                raise
+            throttled = (
+                response.status_code == 429 or response.status_code >= 500
+            )
+            for limiter in self._rate_limiters:
+                if throttled:
+                    limiter.failure()
+                else:
+                    limiter.success()
+            if (response.status_code not in _RETRY_STATUSES
+                    or attempt == attempts - 1):
+                return response
+            response.close()
+        return response
+
+    def _http_session(self):
+        """
+        The requests.Session used for HTTP, created on first use
+        """
+        session = self._session
+        if session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = self._make_session(*self._session_args)
+                session = self._session
+        return session
+
+    def _token_expires_in(self):
+        """
+        Seconds until the current token expires
+        """
+        return _token_expires_in(
+            self._login_data, self._refresh_token_validity_seconds
+        )
+
     def _requires_refresh_token(self):
         """
         Check if a refresh of the token is needed
         """
-        expires_on = self._login_data["last_refresh"] + \
-            datetime.timedelta(seconds=self._refresh_token_validity_seconds)
-        refresh = datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
-        return expires_on < refresh
+        return self._token_expires_in() < 30
 
     def _request_token(self, force=False):
         """
@@ -438,18 +1961,14 @@ class EphEmber:
 
         response = self._http(
             "appLogin/refreshAccessToken",
-            method=requests.get,
+            method="GET",
             headers={'Authorization':
                      self._login_data['data']['refresh_token']}
         )
 
-        refresh_data = response.json()
-
-        if 'token' not in refresh_data.get('data', {}):
+        if not _refresh_login_data(self._login_data, response.json()):
             return False
-
-        self._login_data['data'] = refresh_data['data']
-        self._login_data['last_refresh'] = datetime.datetime.utcnow()
+        self._save_session()
 
         return True
 
@@ -467,34 +1986,164 @@ class EphEmber:
             }
         )
 
-        self._login_data = response.json()
-        if self._login_data['status'] != 0:
-            self._login_data = None
+        self._login_data = _login_data_from_response(response.json())
+        if self._login_data is None:
             return False
-        self._login_data["last_refresh"] = datetime.datetime.utcnow()
-
-        if ('data' in self._login_data
-                and 'token' in self._login_data['data']):
-            return True
-
-        self._login_data = None
-        return False
+        self._save_session()
+        return True
 
     def _do_auth(self):
         """
-        Do authentication to the system (if required)
+        Do authentication to the system (if required).
+        Concurrent callers wait for a single login or refresh.
         """
-        if self._login_data is None:
+        with self._auth_lock:
+            if self._login_data is None:
+                return self._login()
+
+            try:
+                if self._request_token():
+                    return True
+            except RuntimeError:
+                pass
+            # the refresh token was rejected as well
             return self._login()
 
-        return self._request_token()
+    def _save_session(self):
+        """
+        Write tokens, user id, homes and home details to the session
+        cache file, if one is configured. The cache is optional, so a
+        failed write is only logged.
+        """
+        if self._session_cache is None or self._login_data is None:
+            return
+        with self._save_lock:
+            login_data = dict(self._login_data)
+            login_data['last_refresh'] = (
+                login_data['last_refresh'].isoformat()
+            )
+            state = {
+                'username': self._user['username'],
+                'login_data': login_data,
+                'user_id': self._user['user_id'],
+                'homes': self._homes,
+                'home_details': self._home_details
+            }
+            # write to a private temporary file, then atomically replace
+            tmp_path = None
+            try:
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self._session_cache)),
+                    prefix=os.path.basename(self._session_cache) + '.',
+                    suffix='.tmp'
+                )
+                with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                    json.dump(state, cache_file)
+                os.replace(tmp_path, self._session_cache)
+            except OSError as exc:
+                _LOGGER.warning("Unable to write session cache: %s", exc)
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+
+    def _load_session(self):
+        """
+        Restore the state saved by _save_session.
+        Returns False if there is no usable cache for this user.
+        The token is not checked here: a rejected token is renewed
+        on the first request that uses it.
+        """
+        if self._session_cache is None:
+            return False
+        try:
+            with open(self._session_cache, encoding='utf-8') as cache_file:
+                state = json.load(cache_file)
+            if state['username'] != self._user['username']:
+                return False
+            login_data = state['login_data']
+            login_data['last_refresh'] = datetime.datetime.fromisoformat(
+                login_data['last_refresh']
+            )
+            if 'token' not in login_data['data']:
+                return False
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        self._login_data = login_data
+        self._user['user_id'] = state.get('user_id')
+        self._homes = state.get('homes')
+        self._home_details = state.get('home_details')
+        self._home_details_expiry = time.monotonic() + self._static_ttl
+        return True
+
+    def _load_homes(self):
+        """
+        Fetch the list of homes of the account
+        """
+        self._homes = self.list_homes()
+        self._save_session()
+        return self._homes
+
+    def _auth_token(self):
+        """
+        Get a valid auth token, logging in or refreshing if required
+        """
+        with self._auth_lock:
+            if not self._do_auth():
+                raise RuntimeError("Unable to login")
+            return self._login_data["data"]["token"]
+
+    def _renew_rejected_token(self, token):
+        """
+        Renew the token after the API rejected it, unless another
+        thread already did. Falls back to a full login.
+        """
+        with self._auth_lock:
+            if (self._login_data is not None
+                    and self._login_data["data"]["token"] != token):
+                return
+            try:
+                if (self._login_data is not None
+                        and self._request_token(force=True)):
+                    return
+            except RuntimeError:
+                pass
+            self._login()
+
+    def _token_refresher(self):
+        """
+        Background thread renewing the token ahead of its expiry
+        """
+        while True:
+            with self._auth_lock:
+                if self._login_data is None:
+                    delay = 0
+                else:
+                    # at least a second, so a token the server keeps
+                    # short-lived can't make this spin
+                    delay = max(
+                        1, self._token_expires_in() - self._refresh_ahead
+                    )
+            if self._refresher_stop.wait(delay):
+                return
+            try:
+                with self._auth_lock:
+                    if self._login_data is None:
+                        renewed = self._login()
+                    else:
+                        renewed = self._request_token(force=True)
+            # RequestException is an OSError, and a response that isn't
+            # JSON raises ValueError
+            except (RuntimeError, OSError, ValueError):
+                renewed = False
+            if not renewed and self._refresher_stop.wait(30):
+                return
 
     def _get_user_details(self):
         """
         Get user details [user/selectUser]
         """
         response = self._http(
-            "user/selectUser", method=requests.get,
+            "user/selectUser", method="GET",
             send_token=True
         )
         user_details = response.json()
@@ -514,39 +2163,196 @@ class EphEmber:
         if 'id' not in data:
             raise RuntimeError("Cannot get user ID")
         self._user['user_id'] = str(data['id'])
+        self._save_session()
         return self._user['user_id']
 
     def _get_first_gateway_id(self):
         """
         Get the first gatewayid associated with the account
         """
+        if not self._homes:
+            self._load_homes()
         if not self._homes:
             raise RuntimeError("Cannot get gateway id from list of homes.")
         return self._homes[0]['gatewayid']
 
-    def _set_zone_target_temperature(self, zone, target_temperature):
-        return self.messenger.send_zone_commands(
+    def _get_zone(self, name):
+        """
+        Get a Zone. Without a home cache or live updates to read it
+        from, a zone whose zoneid is known is fetched on its own
+        (homesVT/zoneViewProgram) instead of with the whole home.
+        """
+        gateway_id = self._get_first_gateway_id()
+        home = self._static.get(gateway_id)
+        static = home.by_name.get(name) if home is not None else None
+        if (static is not None and static.zoneid is not None
+                and not self._cache_home and self._live_zones is None):
+            # transport and auth errors propagate
+            zone = _zone_from_response(
+                self._zone_view(static.zoneid), missing_ok=True
+            )
+            if zone is not None and zone.get('name') == name:
+                zone = Zone(zone)
+                if (home.fresh()
+                        and zone['deviceDays'] == static.device_days):
+                    zone.schedule = static.schedule
+                return zone
+            # renamed or removed: fall back to the whole home
+            self._static.pop(gateway_id, None)
+        return self.get_zone_index().get_zone(name)
+
+    def _zone_view(self, zone_id):
+        """
+        The homesVT/zoneViewProgram response for a zoneid
+        """
+        def fetch():
+            return self._http(
+                "homesVT/zoneViewProgram", send_token=True,
+                data={"zoneid": zone_id}
+            ).json()
+
+        return self._single_flight.do(
+            ("homesVT/zoneViewProgram", zone_id), fetch
+        )
+
+    def _zone_id(self, name):
+        """
+        Get the zoneid of a named zone, from the static data if possible
+        """
+        home = self._static.get(self._get_first_gateway_id())
+        static = home.by_name.get(name) if home is not None else None
+        if static is not None and static.zoneid is not None:
+            return static.zoneid
+        zone_id = self.get_zone_index().get_zone(name).get('zoneid')
+        if zone_id is None:
+            raise RuntimeError("No zoneid for zone: %s" % name)
+        return zone_id
+
+    def _update_static(self, gateway_id, zones, force=False):
+        """
+        Get the static data of a home, rebuilt from a snapshot of its
+        zones if it is missing, expired or out of date (or force is True)
+        """
+        home = self._static.get(gateway_id)
+        if (force or home is None or not home.fresh()
+                or not home.matches(zones)):
+            home = _StaticHome(zones, time.monotonic() + self._static_ttl)
+            self._static[gateway_id] = home
+        return home
+
+    def _home_generation(self, gateway_id):
+        """
+        Generation of the cached home data of a gateway,
+        call with _home_cache_lock held
+        """
+        return (self._home_epoch, self._home_generations[gateway_id])
+
+    def _fetch_home(self, gateway_id):
+        """
+        Fetch the zones of a home (homesVT/zoneProgram),
+        storing them in the home cache if it is enabled and the
+        cache wasn't invalidated while the request was in flight
+        """
+        with self._home_cache_lock:
+            generation = self._home_generation(gateway_id)
+
+        def fetch():
+            response = self._http(
+                "homesVT/zoneProgram", send_token=True,
+                data={"gateWayId": gateway_id}
+            )
+            zones = _zones_from_response(response.json())
+            if self._cache_home:
+                with self._home_cache_lock:
+                    if self._home_generation(gateway_id) == generation:
+                        self._home_cache[gateway_id] = (
+                            time.monotonic() + self._cache_ttl, zones
+                        )
+            return zones
+
+        # callers after an invalidation don't share an older request
+        return self._single_flight.do(
+            ("homesVT/zoneProgram", gateway_id, generation), fetch
+        )
+
+    def _reseed_live(self, gateway_id):
+        """
+        Replace the live state with a fresh snapshot, to pick up
+        changes of the static data that pushes don't carry
+        """
+        zones = self._fetch_home(gateway_id)
+        with self._live_lock:
+            if self._live_gateway != gateway_id:
+                # live updates were stopped meanwhile
+                return
+            self._live_zones = {zone['mac']: zone for zone in zones}
+            self._live_list = zones
+            self._zone_index = None
+        self._update_static(gateway_id, zones, force=True)
+
+    def _resync_live(self):
+        """
+        Reseed the live state, if live updates are on, after the MQTT
+        connection was re-established and pushes may have been missed
+        """
+        gateway_id = self._live_gateway
+        if gateway_id is None:
+            return
+        try:
+            self._reseed_live(gateway_id)
+        except (RuntimeError, OSError) as exc:
+            # the live state stays as it is until the next reseed
+            _LOGGER.warning("Unable to resync live zone state: %s", exc)
+
+    def _send_zone_commands(self, zone, commands, wait=False, timeout=10):
+        """
+        Send commands to a zone and drop any cached home data,
+        since it no longer reflects the state of the zone.
+
+        If wait is True, wait up to timeout seconds for the zone to
+        push point data showing the new values, and return whether
+        it did.
+        """
+        if wait:
+            result = self.messenger.send_zone_commands(
+                zone, commands, timeout=timeout, confirm=True
+            )
+        else:
+            result = self.messenger.send_zone_commands(zone, commands)
+        self.invalidate_home_cache()
+        return result
+
+    def _set_zone_target_temperature(self, zone, target_temperature,
+                                     wait=False, timeout=10):
+        return self._send_zone_commands(
             zone,
-            ZoneCommand('TARGET_TEMP', target_temperature)
+            ZoneCommand('TARGET_TEMP', target_temperature),
+            wait, timeout
         )
 
-    def _set_zone_boost_temperature(self, zone, target_temperature):
-        return self.messenger.send_zone_commands(
+    def _set_zone_boost_temperature(self, zone, target_temperature,
+                                    wait=False, timeout=10):
+        return self._send_zone_commands(
             zone,
-            ZoneCommand('BOOST_TEMP', target_temperature)
+            ZoneCommand('BOOST_TEMP', target_temperature),
+            wait, timeout
         )
 
-    def _set_zone_advance(self, zone, advance=True):
+    def _set_zone_advance(self, zone, advance=True, wait=False, timeout=10):
         if advance:
             advance = 1
         else:
             advance = 0
-        return self.messenger.send_zone_commands(
+        return self._send_zone_commands(
             zone,
-            ZoneCommand('ADVANCE_ACTIVE', advance)
+            ZoneCommand('ADVANCE_ACTIVE', advance),
+            wait, timeout
         )
 
-    def _set_zone_boost(self, zone, boost_temperature, num_hours, timestamp=0):
+    # wait and timeout follow the zone arguments, as for the other setters
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def _set_zone_boost(self, zone, boost_temperature, num_hours, timestamp=0,
+                        wait=False, timeout=10):
         """
         Internal method to set zone boost
 
@@ -559,18 +2365,14 @@ class EphEmber:
         If timestamp is None, do not send timestamp at all.
         (maybe results in permanent boost?)
         """
-        cmds = [ZoneCommand('BOOST_HOURS', num_hours)]
-        if boost_temperature is not None:
-            cmds.append(ZoneCommand('BOOST_TEMP', boost_temperature))
-        if timestamp is not None:
-            if timestamp == 0:
-                timestamp = int(datetime.datetime.now().timestamp())
-            cmds.append(ZoneCommand('BOOST_TIME', timestamp))
-        return self.messenger.send_zone_commands(zone, cmds)
+        return self._send_zone_commands(
+            zone, zone_boost_commands(boost_temperature, num_hours, timestamp),
+            wait, timeout
+        )
 
-    def _set_zone_mode(self, zone, mode_num):
-        return self.messenger.send_zone_commands(
-            zone, ZoneCommand('MODE', mode_num)
+    def _set_zone_mode(self, zone, mode_num, wait=False, timeout=10):
+        return self._send_zone_commands(
+            zone, ZoneCommand('MODE', mode_num), wait, timeout
         )
 
     # Public interface
@@ -579,95 +2381,119 @@ class EphEmber:
         """
         Credentials required by EphMessenger
         """
-        if not self._do_auth():
-            raise RuntimeError("Unable to login")
+        token = self._auth_token()
 
         return {
             'user_id': self._get_user_id(),
-            'token': self._login_data["data"]["token"]
+            'token': token
         }
 
+    def start_token_refresher(self, refresh_ahead=300):
+        """
+        Renew the auth token in a background thread refresh_ahead
+        seconds before it expires, so requests never wait for it
+        """
+        if not 0 <= refresh_ahead < self._refresh_token_validity_seconds:
+            raise ValueError(
+                "refresh_ahead must be less than the token validity "
+                "of {} seconds".format(self._refresh_token_validity_seconds)
+            )
+        if self._refresher is not None and self._refresher.is_alive():
+            return
+        self._refresh_ahead = refresh_ahead
+        self._refresher_stop.clear()
+        self._refresher = threading.Thread(
+            target=self._token_refresher, name="ember-token-refresher",
+            daemon=True
+        )
+        self._refresher.start()
+
+    def stop_token_refresher(self):
+        """
+        Stop the background token refresh
+        """
+        self._refresher_stop.set()
+        if self._refresher is not None:
+            self._refresher.join()
+            self._refresher = None
+
     def list_homes(self):
         """
         List the homes available for this user
         """
-        response = self._http(
-            "homes/list", method=requests.get, send_token=True
-        )
-        homes = response.json()
-        status = homes.get('status', 1)
-        if status != 0:
-            raise RuntimeError("Error getting home: {}".format(status))
+        def fetch():
+            response = self._http(
+                "homes/list", method="GET", send_token=True
+            )
+            return _homes_from_response(response.json())
 
-        return homes.get("data", [])
+        return self._single_flight.do(("homes/list",), fetch)
+
+    def get_gateway_ids(self, force=False):
+        """
+        Get the gateway ids of all homes associated with the account
+        """
+        if force or not self._homes:
+            self._load_homes()
+        return [home['gatewayid'] for home in self._homes]
 
     def get_home_details(self, gateway_id=None, force=False):
         """
         Get the details about a home (API call: homes/detail)
         If no gateway_id is passed, the first gateway found is used.
+        Only the details of the first gateway are kept.
         """
-        if self._home_details and not force:
+        first = (
+            gateway_id is None or gateway_id == self._get_first_gateway_id()
+        )
+        if (first and self._home_details and not force
+                and self._home_details_expiry > time.monotonic()):
             return self._home_details
 
         if gateway_id is None:
-            if not self._homes:
-                self._homes = self.list_homes()
             gateway_id = self._get_first_gateway_id()
 
-        response = self._http(
-            "homes/detail", send_token=True,
-            data={"gateWayId": gateway_id}
-        )
-
-        home_details = response.json()
-
-        status = home_details.get('status', 1)
-        if status != 0:
-            raise RuntimeError(
-                "Error getting details from home: {}".format(status))
-
-        if "data" not in home_details or "homes" not in home_details["data"]:
-            raise RuntimeError(
-                "Error getting details from home: no home data found")
-
-        self._home_details = home_details['data']
-
-        return home_details["data"]
+        def fetch():
+            response = self._http(
+                "homes/detail", send_token=True,
+                data={"gateWayId": gateway_id}
+            )
+            home_details = _home_details_from_response(response.json())
+            if first:
+                self._home_details = home_details
+                self._home_details_expiry = (
+                    time.monotonic() + self._static_ttl
+                )
+                self._save_session()
+            return home_details
+
+        return self._single_flight.do(("homes/detail", gateway_id), fetch)
     # ["homes"]
 
-    def get_home(self, gateway_id=None):
+    def get_home(self, gateway_id=None, force=False):
         """
         Get the data about a home (API call: homesVT/zoneProgram).
         If no gateway_id is passed, the first gateway found is used.
+
+        If the home cache is enabled and a snapshot younger than
+        cache_ttl seconds is held, it is returned without an API call,
+        unless force is True.
         """
         if gateway_id is None:
-            if not self._homes:
-                self._homes = self.list_homes()
             gateway_id = self._get_first_gateway_id()
 
-        response = self._http(
-            "homesVT/zoneProgram", send_token=True,
-            data={"gateWayId": gateway_id}
-        )
-
-        home = response.json()
+        if self._live_zones is not None and gateway_id == self._live_gateway:
+            home = self._static.get(gateway_id)
+            if home is None or not home.fresh():
+                self._reseed_live(gateway_id)
+            return self._live_home()
 
-        status = home.get('status', 1)
-        if status != 0:
-            raise RuntimeError(
-                "Error getting zones from home: {}".format(status))
-
-        if "data" not in home:
-            raise RuntimeError(
-                "Error getting zones from home: no data found")
-        if "timestamp" not in home:
-            raise RuntimeError(
-                "Error getting zones from home: no timestamp found")
+        if self._cache_home and not force:
+            cached = self._home_cache.get(gateway_id)
+            if cached is not None and cached[0] > time.monotonic():
+                return cached[1]
 
-        for zone in home["data"]:
-            zone["timestamp"] = home["timestamp"]
-
-        return home["data"]
+        return self._fetch_home(gateway_id)
 
     def get_zones(self):
         """
@@ -689,108 +2515,188 @@ class EphEmber:
 
         return zone_names
 
+    def batch(self):
+        """
+        Start a ZoneBatch of commands for many zones
+        """
+        return ZoneBatch(self)
+
+    def get_zone_index(self):
+        """
+        Get all zones as a ZoneIndex, which is only rebuilt
+        when the underlying snapshot changes
+        """
+        zones = self.get_zones()
+        index = self._zone_index
+        if index is None or index.source is not zones:
+            index = ZoneIndex(zones)
+            home = self._update_static(self._get_first_gateway_id(), zones)
+            # reuse the compiled programs of the static data
+            for zone in index.zones:
+                zone.schedule = home.by_mac[zone['mac']].schedule
+            self._zone_index = index
+        return index
+
+    def get_zone_by_id(self, zone_id):
+        """
+        Get the data about a single zone by its zoneid
+        (API call: homesVT/zoneViewProgram)
+        """
+        return _zone_from_response(self._zone_view(zone_id))
+
+    def get_static_zones(self, gateway_id=None, force=False):
+        """
+        Get the static data of the zones of a home, as a list of
+        ZoneStatic. It is refreshed from a homesVT/zoneProgram snapshot
+        every static_ttl seconds, when the zones or programs of a
+        snapshot differ, or when force is True.
+        If no gateway_id is passed, the first gateway found is used.
+        """
+        if gateway_id is None:
+            gateway_id = self._get_first_gateway_id()
+        home = self._static.get(gateway_id)
+        if force or home is None or not home.fresh():
+            home = self._update_static(
+                gateway_id, self.get_home(gateway_id, force=force),
+                force=True
+            )
+        return home.zones
+
+    def invalidate_static(self, gateway_id=None):
+        """
+        Drop the static data (zone names, zoneids, programs and home
+        details) so it is fetched again on next use.
+        If no gateway_id is passed, it is dropped for all gateways.
+        """
+        if gateway_id is None:
+            self._static.clear()
+        else:
+            self._static.pop(gateway_id, None)
+        self._home_details_expiry = 0
+
+    def refresh_zone(self, name):
+        """
+        Fetch the current data of a named zone on its own and put it
+        into any cached home data holding that zone, without
+        extending its cache_ttl. Returns the zone data.
+        """
+        zone = self.get_zone_by_id(self._zone_id(name))
+        with self._home_cache_lock:
+            for gateway_id, (expiry, zones) in list(
+                    self._home_cache.items()):
+                if any(old.get('zoneid') == zone['zoneid']
+                       for old in zones):
+                    self._home_cache[gateway_id] = (expiry, [
+                        zone if old.get('zoneid') == zone['zoneid'] else old
+                        for old in zones
+                    ])
+        return zone
+
     def get_zone(self, name):
         """
         Get the information about a particular zone
         """
-        for zone in self.get_zones():
-            if name == zone['name']:
-                return zone
-
-        raise RuntimeError("Unknown zone: %s" % name)
+        return self._get_zone(name).data
 
     def is_zone_active(self, name):
         """
         Check if a zone is active
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_is_active(zone)
 
     def is_zone_boiler_on(self, name):
         """
         Check if the named zone's boiler is on and burning fuel (experimental)
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return boiler_state(zone) == 2
 
     def get_zone_temperature(self, name):
         """
         Get the temperature for a zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_current_temperature(zone)
 
     def get_zone_target_temperature(self, name):
         """
         Get the temperature for a zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_target_temperature(zone)
 
     def get_zone_boost_temperature(self, name):
         """
         Get the boost target temperature for a zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_boost_temperature(zone)
 
     def is_boost_active(self, name):
         """
         Check if boost is active for a zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_is_boost_active(zone)
 
     def boost_hours(self, name):
         """
         Get the boost duration for a zone, in hours
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_boost_hours(zone)
 
     def boost_timestamp(self, name):
         """
         Get the timestamp recorded for the boost
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return datetime.datetime.fromtimestamp(zone_boost_timestamp(zone))
 
     def is_target_temperature_reached(self, name):
         """
         Check if a zone temperature has reached the target temperature
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_current_temperature(zone) >= zone_target_temperature(zone)
 
-    def set_zone_target_temperature(self, name, target_temperature):
+    # The setters return whether the command was published. With
+    # wait=True they instead wait up to timeout seconds for the zone to
+    # report the new values over MQTT, and return whether it did.
+
+    def set_zone_target_temperature(self, name, target_temperature,
+                                    wait=False, timeout=10):
         """
         Set the target temperature for a named zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return self._set_zone_target_temperature(
-            zone, target_temperature
+            zone, target_temperature, wait, timeout
         )
 
-    def set_zone_boost_temperature(self, name, target_temperature):
+    def set_zone_boost_temperature(self, name, target_temperature,
+                                   wait=False, timeout=10):
         """
         Set the boost target temperature for a named zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return self._set_zone_boost_temperature(
-            zone, target_temperature
+            zone, target_temperature, wait, timeout
         )
 
-    def set_zone_advance(self, name, advance_state=True):
+    def set_zone_advance(self, name, advance_state=True,
+                         wait=False, timeout=10):
         """
         Set the advance state for a named zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return self._set_zone_advance(
-            zone, advance_state
+            zone, advance_state, wait, timeout
         )
 
     def activate_zone_boost(self, name, boost_temperature=None,
-                            num_hours=1, timestamp=0):
+                            num_hours=1, timestamp=0, wait=False, timeout=10):
         """
         Turn on boost for a named zone
 
@@ -803,17 +2709,19 @@ class EphEmber:
 
         """
         return self._set_zone_boost(
-            self.get_zone(name), boost_temperature,
-            num_hours, timestamp=timestamp
+            self._get_zone(name), boost_temperature,
+            num_hours, timestamp=timestamp, wait=wait, timeout=timeout
         )
 
-    def deactivate_zone_boost(self, zone):
+    def deactivate_zone_boost(self, zone, wait=False, timeout=10):
         """
         Turn off boost for a named zone
         """
-        return self.activate_zone_boost(zone, num_hours=0, timestamp=None)
+        return self.activate_zone_boost(
+            zone, num_hours=0, timestamp=None, wait=wait, timeout=timeout
+        )
 
-    def set_zone_mode(self, name, mode):
+    def set_zone_mode(self, name, mode, wait=False, timeout=10):
         """
         Set the mode by using the name of the zone
         Supported zones are available in the enum ZoneMode
@@ -824,46 +2732,248 @@ class EphEmber:
         assert isinstance(mode, ZoneMode)
 
         return self._set_zone_mode(
-            self.get_zone(name), mode.value
+            self._get_zone(name), mode.value, wait, timeout
         )
 
     def get_zone_mode(self, name):
         """
         Get the mode for a zone
         """
-        zone = self.get_zone(name)
+        zone = self._get_zone(name)
         return zone_mode(zone)
 
+    def _live_home(self):
+        """
+        Zone data of the live state, stamped with the current time
+        """
+        timestamp = int(1000*time.time())
+        with self._live_lock:
+            zones = self._live_list
+            for zone in zones:
+                zone['timestamp'] = timestamp
+        return zones
+
+    def _apply_pointdata(self, mac, values):
+        """
+        Patch the live zone state with pushed point data
+        """
+        with self._live_lock:
+            if self._live_zones is None:
+                # a push that raced stop_live_updates
+                return
+            zone = self._live_zones.get(mac)
+            if zone is None:
+                return
+            self._zone_index = None
+            point_data = {
+                datum['pointIndex']: datum for datum in zone['pointDataList']
+            }
+            for index, value in values.items():
+                if index in point_data:
+                    point_data[index]['value'] = str(value)
+                else:
+                    zone['pointDataList'].append(
+                        {'pointIndex': index, 'value': str(value)}
+                    )
+            callback = self._live_callback
+        if callback is not None:
+            callback(mac, values)
+
+    def start_live_updates(self, on_pointdata=None):
+        """
+        Keep zone data up to date from MQTT upload/pointdata pushes.
+
+        The state is seeded with one homesVT/zoneProgram call; after that
+        the zone getters answer from memory without any HTTP requests.
+
+        If given, on_pointdata(mac, values) is called after each push
+        has been applied, e.g. ZoneWatcher.apply_pointdata.
+        """
+        gateway_id = self._get_first_gateway_id()
+        zones = self._fetch_home(gateway_id)
+        self._update_static(gateway_id, zones, force=True)
+        with self._live_lock:
+            self._live_zones = {zone['mac']: zone for zone in zones}
+            self._live_list = zones
+            self._live_gateway = gateway_id
+            self._live_callback = on_pointdata
+        return self.messenger.subscribe_pointdata(self._apply_pointdata)
+
+    def stop_live_updates(self):
+        """
+        Stop MQTT pushes and go back to fetching zone data over HTTP
+        """
+        self.messenger.unsubscribe_pointdata()
+        with self._live_lock:
+            self._live_zones = None
+            self._live_list = None
+            self._live_gateway = None
+            self._live_callback = None
+
+    def invalidate_home_cache(self, gateway_id=None):
+        """
+        Drop cached home data so the next read fetches it from the API.
+        If no gateway_id is passed, the cache for all gateways is dropped.
+        """
+        with self._home_cache_lock:
+            if gateway_id is None:
+                self._home_epoch += 1
+                self._home_cache.clear()
+            else:
+                self._home_generations[gateway_id] += 1
+                self._home_cache.pop(gateway_id, None)
+
     def reset_login(self):
         """
         reset the login data to force a re-login
         """
         self._login_data = None
 
-    # Ctor
-    def __init__(self, username, password, cache_home=False):
-        """Performs login and save session cookie."""
+    def close(self):
+        """
+        Close the pooled HTTP connections and the MQTT connection
+        """
+        self.stop_token_refresher()
+        self.messenger.stop()
+        if self._session is not None:
+            self._session.close()
+
+    @staticmethod
+    def _make_session(pool_size, retries, backoff_factor,
+                      retry_status=True):
+        """
+        Create a requests.Session keeping pool_size connections alive,
+        retrying connection errors and, if retry_status, 5xx responses
+        with backoff
+        """
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
 
-        if cache_home:
-            raise RuntimeError("cache_home not implemented")
+        retry = Retry(
+            total=retries, backoff_factor=backoff_factor,
+            status_forcelist=_RETRY_STATUSES if retry_status else (),
+            allowed_methods=frozenset(["GET", "POST"]),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size,
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    # Ctor
+    # every option is a keyword argument with a default, kept positional
+    # for compatibility
+    # pylint: disable=too-many-arguments,too-many-positional-arguments
+    def __init__(self, username, password, cache_home=False, cache_ttl=30,
+                 persistent_mqtt=False, session=None, pool_size=4,
+                 retries=3, backoff_factor=0.5, session_cache=None,
+                 lazy_login=False, rate_limit=None, rate_limiter=None,
+                 static_ttl=3600):
+        """
+        Performs login and save session cookie.
+
+        If lazy_login is True, no I/O is done here: login happens on
+        the first call that needs a token.
+
+        Static data (zone names, zoneids, weekly programs and home
+        details) is kept for static_ttl seconds, separately from the
+        point values, see get_static_zones.
+
+        rate_limit limits this client to that many HTTP requests per
+        second (see RateLimiter); rate_limiter is a RateLimiter shared
+        with other clients, e.g. to limit all the accounts of a fleet.
+
+        If session_cache is a file path, tokens, user id, homes and home
+        details are saved there (readable by the owner only). A later
+        client for the same user starts from that file without logging
+        in, and only logs in again if the cached token is rejected.
+
+        HTTP requests share a keep-alive connection pool. Pass a
+        requests.Session as session to configure it yourself, otherwise
+        one is created with pool_size connections and a retry policy of
+        retries attempts with exponential backoff_factor.
+
+        If cache_home is True, zone data from homesVT/zoneProgram is kept
+        for cache_ttl seconds and shared by all the zone getters.
+
+        If persistent_mqtt is True, zone commands are sent over one
+        long-lived MQTT connection (see EphMessenger).
+        """
+
+        self._cache_home = cache_home
+        self._cache_ttl = cache_ttl
+        # gateway_id -> (expiry on the monotonic clock, zone data)
+        self._home_cache = {}
+        # bumped by invalidate_home_cache, for all gateways (the epoch)
+        # or for one, so fetches that started earlier aren't cached
+        self._home_epoch = 0
+        self._home_generations = collections.defaultdict(int)
+        self._home_cache_lock = threading.Lock()
+
+        # mac -> zone data, patched by MQTT pushes (see start_live_updates)
+        self._live_zones = None
+        self._live_list = None
+        self._live_gateway = None
+        self._live_callback = None
+        self._live_lock = threading.Lock()
+
+        # ZoneIndex of the latest snapshot, see get_zone_index
+        self._zone_index = None
+        # gateway_id -> _StaticHome: names, zoneids and programs of the
+        # zones, refreshed every static_ttl seconds (see get_static_zones)
+        self._static = {}
+        self._static_ttl = static_ttl
 
         self._login_data = None
-        self._user = {
-            'user_id': None,
-            'username': username,
-            'password': password
-        }
+        self._user = _user_details(username, password)
 
         # This is the list of homes / gateways associated with the account.
         self._homes = None
 
         self._home_details = None
+        self._home_details_expiry = 0
 
         self._refresh_token_validity_seconds = 1800
 
+        # shares in-flight list_homes / get_home / get_home_details calls
+        self._single_flight = _SingleFlight()
+
+        # serializes login and token refresh between threads
+        self._auth_lock = threading.RLock()
+        self._refresher = None
+        self._refresher_stop = threading.Event()
+        self._refresh_ahead = 300
+
         self.http_api_base = 'https://eu-https.topband-cloud.com/ember-back/'
 
-        self.messenger = EphMessenger(self)
+        self._rate_limiters = tuple(
+            limiter for limiter in (
+                RateLimiter(rate_limit) if rate_limit else None,
+                rate_limiter
+            ) if limiter is not None
+        )
+
+        # created by _http_session on first use unless one is given.
+        # With rate limiters, _send retries 5xx responses instead.
+        self._session = session
+        self._session_args = (
+            pool_size, retries, backoff_factor, not self._rate_limiters
+        )
+        self._session_lock = threading.Lock()
+        self._retries = retries
+
+        self.messenger = EphMessenger(self, persistent=persistent_mqtt)
+
+        self._session_cache = session_cache
+        self._save_lock = threading.Lock()
+        if self._load_session() or lazy_login:
+            return
 
         if not self._login():
             raise RuntimeError("Unable to login.")
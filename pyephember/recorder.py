@@ -0,0 +1,267 @@
+"""
+Compact columnar recording of zone telemetry
+
+Requires numpy.
+"""
+# pylint: disable=consider-using-f-string
+
+import os
+import struct
+import threading
+import time
+
+import numpy
+
+from .pyephember import PointIndex, Zone
+
+
+# Value dtype of each point, by the point type used for it in the API.
+# Points not listed are stored as 32 bit values.
+_FIELD_DTYPES = {
+    'ADVANCE_ACTIVE': '<u1',
+    'CURRENT_TEMP': '<u2',
+    'TARGET_TEMP': '<u2',
+    'MODE': '<u1',
+    'BOOST_HOURS': '<u1',
+    'BOOST_TIME': '<u4',
+    'BOILER_STATE': '<u1',
+    'BOOST_TEMP': '<u2',
+}
+
+_POINT_NAMES = {point.value: point.name for point in PointIndex}
+
+# time file: int64 base timestamp, then one uint16 delta per sample
+_HEADER = struct.Struct('<q')
+_DELTA_DTYPE = '<u2'
+_MAX_DELTA = 0xffff
+
+
+def _field_name(index):
+    """
+    Field name of a point index: its PointIndex name,
+    or POINT_<index> for points without one
+    """
+    if isinstance(index, PointIndex):
+        return index.name
+    if isinstance(index, str):
+        return index
+    return _POINT_NAMES.get(index, 'POINT_{}'.format(index))
+
+
+class _Series:
+    """
+    One field of one zone: a time file of delta-encoded timestamps
+    (seconds) and a value file, appended to in step
+    """
+
+    def __init__(self, path, name):
+        self.time_path = os.path.join(path, name + '.t')
+        self.value_path = os.path.join(path, name + '.v')
+        self.dtype = numpy.dtype(_FIELD_DTYPES.get(name, '<u4'))
+        self.last_time = None
+        self.last_value = None
+        if os.path.exists(self.time_path):
+            self._truncate()
+            times, values = self.load()
+            if len(times):
+                self.last_time = int(times[-1])
+                self.last_value = int(values[-1])
+
+    def _truncate(self):
+        """
+        Cut both files back to the samples they have in common, as a
+        write may have been interrupted between them, so that later
+        appends stay paired
+        """
+        if not os.path.exists(self.value_path):
+            with open(self.value_path, 'wb'):
+                pass
+        deltas = max(0, os.path.getsize(self.time_path) - _HEADER.size)
+        count = min(
+            deltas // numpy.dtype(_DELTA_DTYPE).itemsize,
+            os.path.getsize(self.value_path) // self.dtype.itemsize
+        )
+        os.truncate(
+            self.time_path,
+            min(os.path.getsize(self.time_path),
+                _HEADER.size + count * numpy.dtype(_DELTA_DTYPE).itemsize)
+        )
+        os.truncate(self.value_path, count * self.dtype.itemsize)
+
+    def append(self, timestamp, value):
+        """
+        Record value at timestamp if it differs from the last value.
+        Returns True if a sample was written.
+        """
+        if self.last_time is not None:
+            if timestamp < self.last_time or value == self.last_value:
+                return False
+
+        deltas = []
+        values = []
+        if self.last_time is None:
+            with open(self.time_path, 'wb') as time_file:
+                time_file.write(_HEADER.pack(timestamp))
+            with open(self.value_path, 'wb'):
+                pass
+            deltas.append(0)
+        else:
+            delta = timestamp - self.last_time
+            # bridge long gaps with repeats of the previous value
+            while delta > _MAX_DELTA:
+                deltas.append(_MAX_DELTA)
+                values.append(self.last_value)
+                delta -= _MAX_DELTA
+            deltas.append(delta)
+        values.append(value)
+
+        with open(self.time_path, 'ab') as time_file:
+            time_file.write(
+                numpy.asarray(deltas, dtype=_DELTA_DTYPE).tobytes()
+            )
+        with open(self.value_path, 'ab') as value_file:
+            value_file.write(numpy.asarray(values, dtype=self.dtype).tobytes())
+
+        self.last_time = timestamp
+        self.last_value = value
+        return True
+
+    def load(self):
+        """
+        Memory-map the files, returning (timestamps, values) arrays
+        """
+        if (os.path.getsize(self.time_path) <= _HEADER.size
+                or not os.path.getsize(self.value_path)):
+            return (numpy.empty(0, dtype=numpy.int64),
+                    numpy.empty(0, dtype=self.dtype))
+        with open(self.time_path, 'rb') as time_file:
+            base = _HEADER.unpack(time_file.read(_HEADER.size))[0]
+        deltas = numpy.memmap(
+            self.time_path, dtype=_DELTA_DTYPE, mode='r',
+            offset=_HEADER.size
+        )
+        values = numpy.memmap(self.value_path, dtype=self.dtype, mode='r')
+        # a write may have been interrupted between the two files
+        count = min(len(deltas), len(values))
+        times = numpy.cumsum(deltas[:count], dtype=numpy.int64) + base
+        return times, values[:count]
+
+
+class ZoneRecorder:
+    """
+    Records zone point values into a directory, with one pair of
+    memory-mapped files per point per zone MAC.
+
+    Only changes are stored: a sample is written when a point's value
+    differs from the last one recorded, so a point's value at time t is
+    the value of its latest sample at or before t.
+
+    Example usage: recorder = ZoneRecorder('/var/lib/ember')
+                   recorder.record_zones(t.get_zones())
+                   times, temps = recorder.query(mac, 'CURRENT_TEMP')
+    """
+
+    def _series(self, mac, index):
+        """
+        Get the series of a point of a zone, creating it if needed
+        """
+        name = _field_name(index)
+        key = (mac, name)
+        series = self._open.get(key)
+        if series is None:
+            if os.path.basename(mac) != mac or mac in ('', '.', '..'):
+                raise ValueError("Invalid zone mac: {!r}".format(mac))
+            path = os.path.join(self.directory, mac)
+            os.makedirs(path, exist_ok=True)
+            series = _Series(path, name)
+            self._open[key] = series
+        return series
+
+    # Public interface
+
+    def record_pointdata(self, mac, values, timestamp=None):
+        """
+        Record point values of a zone, as {point index: value}.
+        The signature matches EphMessenger.subscribe_pointdata callbacks.
+        timestamp is in seconds and defaults to now.
+        Returns the number of samples written.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        timestamp = int(timestamp)
+        written = 0
+        with self._lock:
+            for index, value in values.items():
+                if value is None:
+                    continue
+                if self._series(mac, index).append(timestamp, int(value)):
+                    written += 1
+        return written
+
+    def record_zones(self, zones):
+        """
+        Record all point values of a snapshot of zones (zone dicts or
+        Zone objects), at the snapshot timestamp.
+        Returns the number of samples written.
+        """
+        written = 0
+        for zone in zones:
+            if not isinstance(zone, Zone):
+                zone = Zone(zone)
+            values = {
+                index: value for index, value in enumerate(zone.points)
+                if value is not None
+            }
+            written += self.record_pointdata(
+                zone['mac'], values, zone['timestamp'] / 1000
+            )
+        return written
+
+    def macs(self):
+        """
+        MACs of all recorded zones
+        """
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if os.path.isdir(os.path.join(self.directory, name))
+        )
+
+    def fields(self, mac):
+        """
+        Names of the points recorded for a zone
+        """
+        path = os.path.join(self.directory, mac)
+        if not os.path.isdir(path):
+            return []
+        return sorted(
+            name[:-2] for name in os.listdir(path) if name.endswith('.t')
+        )
+
+    def query(self, mac, index, start=None, end=None):
+        """
+        Samples of a point of a zone with start <= time < end
+        (seconds, either may be None for no limit), as a pair of numpy
+        arrays (timestamps, values). The arrays are views on the
+        memory-mapped files where possible.
+        """
+        name = _field_name(index)
+        with self._lock:
+            series = self._open.get((mac, name))
+            if series is None:
+                path = os.path.join(self.directory, mac)
+                if not os.path.exists(os.path.join(path, name + '.t')):
+                    return (numpy.empty(0, dtype=numpy.int64),
+                            numpy.empty(0, dtype=numpy.uint32))
+                series = self._series(mac, name)
+            times, values = series.load()
+
+        first = 0 if start is None else numpy.searchsorted(times, start)
+        last = len(times) if end is None else numpy.searchsorted(times, end)
+        return times[first:last], values[first:last]
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # (mac, field name) -> _Series
+        self._open = {}
+        self._lock = threading.Lock()
@@ -0,0 +1,542 @@
+"""
+Live zone state in shared memory, written by one owner process and
+read by any number of other processes on the same host
+"""
+# pylint: disable=consider-using-f-string
+
+import mmap
+import os
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from .pyephember import (
+    Zone, ZoneIndex, ZoneMode, _POINT_SLOTS, _point_index_value,
+    zone_current_temperature, zone_target_temperature
+)
+
+# Segment layout, all little endian:
+#
+#   0  magic, format, max zones, point slots per zone
+#  16  sequence number: odd while the owner is writing
+#  24  layout generation, zone count, time of the last write
+#  64  max zones records of: mac, name, bit mask of the points that
+#      have a value, then one int64 value per point slot
+#
+# The sequence number is 8 byte aligned, so it is written in one store.
+_MAGIC = b'EPHZ'
+_FORMAT = 1
+_HEADER = struct.Struct('<4sHHH')
+_SEQ_OFFSET = 16
+_SEQ = struct.Struct('<Q')
+_STATE_OFFSET = 24
+_STATE = struct.Struct('<QH6xd')
+_ZONES_OFFSET = 64
+_ZONE = struct.Struct('<32s64sQ')
+_VALUE = struct.Struct('<q')
+_MASK_OFFSET = 96
+
+
+def _zone_size(slots):
+    """
+    Size of a zone record with slots point values
+    """
+    return _ZONE.size + _VALUE.size * slots
+
+
+def _segment_size(max_zones, slots):
+    """
+    Size of a segment for max_zones zones
+    """
+    return _ZONES_OFFSET + max_zones * _zone_size(slots)
+
+
+def _attach(name):
+    """
+    Map an existing segment read-only, returning (mmap, closer)
+    """
+    if os.name != 'posix':
+        segment = shared_memory.SharedMemory(name=name)
+        return segment.buf, segment.close
+    # SharedMemory can only map read-write, and before Python 3.13 it
+    # registers attached segments with the resource tracker, which
+    # unlinks them when the reader exits
+    import _posixshmem  # pylint: disable=import-outside-toplevel
+    fd = _posixshmem.shm_open('/' + name.lstrip('/'), os.O_RDONLY, 0o600)
+    try:
+        buf = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    finally:
+        os.close(fd)
+    return buf, buf.close
+
+
+def _read_directory(buf, slots):
+    """
+    Layout generation and zone (name, mac) list of a segment
+    """
+    generation, count = _STATE.unpack_from(buf, _STATE_OFFSET)[:2]
+    size = _zone_size(slots)
+    zones = []
+    for slot in range(count):
+        mac, name = _ZONE.unpack_from(buf, _ZONES_OFFSET + slot * size)[:2]
+        zones.append((
+            name.rstrip(b'\0').decode('utf-8'),
+            mac.rstrip(b'\0').decode('utf-8'),
+        ))
+    return generation, zones
+
+
+def _read_point(buf, offset, index):
+    """
+    Layout generation and value of a point of the zone record at
+    offset, or None if the point has no value
+    """
+    generation = _STATE.unpack_from(buf, _STATE_OFFSET)[0]
+    mask = _SEQ.unpack_from(buf, offset + _MASK_OFFSET)[0]
+    if not mask >> index & 1:
+        return generation, None
+    return generation, _VALUE.unpack_from(
+        buf, offset + _ZONE.size + _VALUE.size * index
+    )[0]
+
+
+def _read_points(buf, offset, slots):
+    """
+    Layout generation and point values (None where there is no value)
+    of the zone record at offset
+    """
+    generation = _STATE.unpack_from(buf, _STATE_OFFSET)[0]
+    mask = _SEQ.unpack_from(buf, offset + _MASK_OFFSET)[0]
+    values = struct.unpack_from('<%dq' % slots, buf, offset + _ZONE.size)
+    return generation, [
+        value if mask >> index & 1 else None
+        for index, value in enumerate(values)
+    ]
+
+
+class ZoneStateOwner:
+    """
+    Keeps the live point values of zones in a fixed-layout shared memory
+    segment, for ZoneStateReader instances in other processes.
+
+    Writes are guarded by a sequence lock: the sequence number is odd
+    while a write is in progress, and readers retry until they see the
+    same even number before and after their read. The owner never waits
+    for readers.
+
+    Example usage: owner = ZoneStateOwner(name='ember-home')
+                   owner.follow(t)
+                   ... fork web workers, each with
+                   ZoneStateReader('ember-home')
+    """
+
+    # the segment, its layout and the writer's bookkeeping
+    # pylint: disable=too-many-instance-attributes
+
+    def _write_zone(self, slot, mac, name, points):
+        """
+        Write the record of a zone (mac and name as bytes); call inside
+        a write
+        """
+        mask = 0
+        values = [0] * self.slots
+        for index, value in enumerate(points[:self.slots]):
+            if value is not None:
+                mask |= 1 << index
+                values[index] = value
+        offset = _ZONES_OFFSET + slot * self._zone_size
+        _ZONE.pack_into(self._buf, offset, mac, name, mask)
+        struct.pack_into(
+            '<%dq' % self.slots, self._buf, offset + _ZONE.size, *values
+        )
+
+    def _begin(self):
+        """
+        Start a write: make the sequence number odd
+        """
+        self._seq += 1
+        _SEQ.pack_into(self._buf, _SEQ_OFFSET, self._seq)
+
+    def _end(self, generation=None):
+        """
+        End a write: stamp the state and make the sequence number even
+        """
+        if generation is not None:
+            self._generation = generation
+        _STATE.pack_into(
+            self._buf, _STATE_OFFSET,
+            self._generation, len(self._slots), time.time()
+        )
+        self._seq += 1
+        _SEQ.pack_into(self._buf, _SEQ_OFFSET, self._seq)
+
+    def _apply(self, mac, values):
+        """
+        Write pushed point data of a zone; call with the lock held
+        """
+        slot = self._slots.get(mac)
+        if slot is None:
+            return
+        offset = _ZONES_OFFSET + slot * self._zone_size
+        mask = _SEQ.unpack_from(self._buf, offset + _MASK_OFFSET)[0]
+        self._begin()
+        try:
+            for index, value in values.items():
+                if index >= self.slots or value is None:
+                    continue
+                mask |= 1 << index
+                _VALUE.pack_into(
+                    self._buf,
+                    offset + _ZONE.size + _VALUE.size * index, value
+                )
+            _SEQ.pack_into(self._buf, offset + _MASK_OFFSET, mask)
+        finally:
+            self._end()
+
+    def _reseed(self):
+        """
+        Rewrite the state from the followed EphEmber. Pushes that arrive
+        while its snapshot is fetched are kept and applied again on top
+        of it by update, so the older snapshot can't overwrite them.
+        """
+        with self._lock:
+            if self._pushes is None:
+                self._pushes = []
+        try:
+            self.update(self._ember.get_zones())
+        finally:
+            with self._lock:
+                self._pushes = None
+
+    # Public interface
+
+    @property
+    def name(self):
+        """
+        Name of the shared memory segment, to pass to ZoneStateReader
+        """
+        return self._segment.name
+
+    def update(self, zones):
+        """
+        Replace the state with a snapshot of zones (zone dicts, Zone
+        objects or a ZoneIndex)
+        """
+        if not isinstance(zones, ZoneIndex):
+            zones = ZoneIndex(zones)
+        if len(zones) > self.max_zones:
+            raise ValueError(
+                "%d zones, the segment holds %d" % (len(zones), self.max_zones)
+            )
+        directory = [(zone['mac'], zone['name']) for zone in zones]
+        encoded = [
+            (mac.encode('utf-8'), name.encode('utf-8'))
+            for mac, name in directory
+        ]
+        for mac, name in encoded:
+            if len(mac) > 32 or len(name) > 64:
+                raise ValueError(
+                    "Zone mac or name too long: %r" % ((mac, name),)
+                )
+        with self._lock:
+            generation = self._generation
+            if directory != self._directory:
+                generation += 1
+            self._begin()
+            try:
+                for slot, zone in enumerate(zones):
+                    self._write_zone(slot, *encoded[slot], zone.points)
+                self._directory = directory
+                self._slots = {
+                    mac: slot for slot, (mac, _) in enumerate(directory)
+                }
+            finally:
+                self._end(generation)
+            # pushes received while a followed snapshot was fetched
+            for mac, values in self._pushes or ():
+                self._apply(mac, values)
+            if self._pushes is not None:
+                self._pushes = []
+
+    def apply_pointdata(self, mac, values):
+        """
+        Apply pushed point data {point index: value} of a zone.
+        The signature matches EphMessenger.subscribe_pointdata callbacks.
+        Points beyond the segment's point slots are dropped.
+        """
+        with self._lock:
+            if self._pushes is not None:
+                self._pushes.append((mac, values))
+            self._apply(mac, values)
+
+    def follow(self, ember):
+        """
+        Seed the state from an EphEmber and keep it up to date with its
+        MQTT pushes (see EphEmber.start_live_updates)
+        """
+        self._ember = ember
+        with self._lock:
+            # buffer pushes from the start, see _reseed
+            self._pushes = []
+        ember.start_live_updates(on_pointdata=self.apply_pointdata)
+        self._reseed()
+        return self
+
+    def refresh(self):
+        """
+        Rewrite the state from the followed EphEmber, to pick up added,
+        removed or renamed zones
+        """
+        if self._ember is None:
+            raise RuntimeError("Not following an EphEmber")
+        self._reseed()
+
+    def close(self):
+        """
+        Stop following pushes and remove the segment.
+        Attached readers keep their mapping until they close.
+        """
+        if self._ember is not None:
+            self._ember.stop_live_updates()
+            self._ember = None
+        self._buf = None
+        self._segment.close()
+        self._segment.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __init__(self, name=None, max_zones=64):
+        """
+        Create a segment for up to max_zones zones. name defaults to a
+        random name; see the name attribute.
+        """
+        self.max_zones = max_zones
+        self.slots = _POINT_SLOTS
+        self._zone_size = _zone_size(self.slots)
+        self._segment = shared_memory.SharedMemory(
+            name=name, create=True,
+            size=_segment_size(max_zones, self.slots)
+        )
+        self._buf = self._segment.buf
+        _HEADER.pack_into(self._buf, 0, _MAGIC, _FORMAT, max_zones,
+                          self.slots)
+        self._seq = 0
+        self._generation = 0
+        # (mac, name) of each slot, and mac -> slot
+        self._directory = []
+        self._slots = {}
+        self._ember = None
+        # pushes kept while a snapshot is fetched, see _reseed
+        self._pushes = None
+        self._lock = threading.Lock()
+        self._begin()
+        self._end()
+
+
+class ZoneStateReader:
+    """
+    Read-only view of the zone state of a ZoneStateOwner, possibly in
+    another process. Reads unpack values straight from the shared
+    segment, without any network I/O.
+
+    The getters match those of EphEmber that only need point values.
+    Zone schedules are not shared, so there is no is_zone_active.
+    """
+
+    # the mapping, its layout and the cached directory
+    # pylint: disable=too-many-instance-attributes
+
+    def _read(self, reader, *args):
+        """
+        Call reader(buf, *args) until it ran without a write in between
+        """
+        deadline = None
+        while True:
+            seq = _SEQ.unpack_from(self._buf, _SEQ_OFFSET)[0]
+            if not seq & 1:
+                result = reader(self._buf, *args)
+                if _SEQ.unpack_from(self._buf, _SEQ_OFFSET)[0] == seq:
+                    return result
+            if deadline is None:
+                deadline = time.monotonic() + self.timeout
+            elif time.monotonic() > deadline:
+                raise RuntimeError(
+                    "Zone state write did not finish, "
+                    "the owner may have died"
+                )
+            time.sleep(0)
+
+    def _load_directory(self):
+        """
+        Read the zone names and macs of the current layout
+        """
+        generation, zones = self._read(_read_directory, self.slots)
+        self._generation = generation
+        self._names = [name for name, _ in zones]
+        self._by_name = {
+            name: (slot, mac) for slot, (name, mac) in enumerate(zones)
+        }
+
+    def _lookup(self, name):
+        """
+        Slot and mac of a named zone
+        """
+        if self._generation is None:
+            self._load_directory()
+        try:
+            return self._by_name[name]
+        except KeyError:
+            raise RuntimeError("Unknown zone: %s" % name) from None
+
+    def _value(self, name, field):
+        """
+        Value of a point of a named zone, or None
+        """
+        index = _point_index_value(field)
+        if not 0 <= index < self.slots:
+            return None
+        while True:
+            slot = self._lookup(name)[0]
+            generation, value = self._read(
+                _read_point, _ZONES_OFFSET + slot * self._zone_size, index
+            )
+            if generation == self._generation:
+                return value
+            # the zones changed since the lookup
+            self._generation = None
+
+    # Public interface
+
+    @property
+    def updated(self):
+        """
+        Time (seconds since the epoch) of the owner's last write
+        """
+        return self._read(
+            lambda buf: _STATE.unpack_from(buf, _STATE_OFFSET)[2]
+        )
+
+    @property
+    def version(self):
+        """
+        Sequence number of the state, which changes with every write
+        """
+        return _SEQ.unpack_from(self._buf, _SEQ_OFFSET)[0]
+
+    def get_zone_names(self):
+        """
+        Get the name of all zones
+        """
+        self._load_directory()
+        return list(self._names)
+
+    def get_zone_points(self, name):
+        """
+        Get the point values of a named zone as a Zone, read at once
+        """
+        while True:
+            slot, mac = self._lookup(name)
+            generation, points = self._read(
+                _read_points, _ZONES_OFFSET + slot * self._zone_size,
+                self.slots
+            )
+            if generation == self._generation:
+                break
+            self._generation = None
+        zone = Zone({'name': name, 'mac': mac, 'pointDataList': []})
+        zone.points = points
+        return zone
+
+    def get_zone_value(self, name, field):
+        """
+        Get a point value of a named zone (PointIndex, name or integer
+        index), or None
+        """
+        return self._value(name, field)
+
+    def get_zone_temperature(self, name):
+        """
+        Get the temperature for a zone
+        """
+        return self._value(name, 'CURRENT_TEMP') / 10
+
+    def get_zone_target_temperature(self, name):
+        """
+        Get the target temperature for a zone
+        """
+        return self._value(name, 'TARGET_TEMP') / 10
+
+    def get_zone_boost_temperature(self, name):
+        """
+        Get the boost target temperature for a zone
+        """
+        return self._value(name, 'BOOST_TEMP') / 10
+
+    def get_zone_mode(self, name):
+        """
+        Get the mode for a zone
+        """
+        return ZoneMode(self._value(name, 'MODE'))
+
+    def is_boost_active(self, name):
+        """
+        Check if boost is active for a zone
+        """
+        return self._value(name, 'BOOST_HOURS') > 0
+
+    def boost_hours(self, name):
+        """
+        Get the boost duration for a zone, in hours
+        """
+        return self._value(name, 'BOOST_HOURS')
+
+    def is_zone_boiler_on(self, name):
+        """
+        Check if the named zone's boiler is on and burning fuel (experimental)
+        """
+        return self._value(name, 'BOILER_STATE') == 2
+
+    def is_target_temperature_reached(self, name):
+        """
+        Check if a zone temperature has reached the target temperature
+        """
+        zone = self.get_zone_points(name)
+        return zone_current_temperature(zone) >= zone_target_temperature(zone)
+
+    def close(self):
+        """
+        Unmap the segment
+        """
+        if self._close is not None:
+            self._buf = None
+            self._close()
+            self._close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __init__(self, name, timeout=1.0):
+        """
+        Attach to the segment of a ZoneStateOwner by name. A read raises
+        RuntimeError if a write has not finished after timeout seconds.
+        """
+        self.timeout = timeout
+        self._buf, self._close = _attach(name)
+        magic, version, max_zones, slots = _HEADER.unpack_from(self._buf, 0)
+        if magic != _MAGIC or version != _FORMAT:
+            self.close()
+            raise RuntimeError("Not a zone state segment: %s" % name)
+        self.max_zones = max_zones
+        self.slots = slots
+        self._zone_size = _zone_size(slots)
+        self._generation = None
+        self._names = []
+        self._by_name = {}
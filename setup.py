@@ -17,6 +17,10 @@ setup(
         'requests',
         'paho-mqtt'
     ],
+    extras_require={
+        'async': ['aiohttp'],
+        'numpy': ['numpy']
+    },
     test_requires=[
         'tox',
         'flake8',
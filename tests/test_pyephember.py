@@ -0,0 +1,317 @@
+"""
+Tests of pyephember: the pointData codec, compiled zone schedules and
+zone diffs, and the client against the local fake cloud of the
+benchmarks (caching, token renewal, rate limiting, batches and the
+session cache)
+"""
+import datetime
+import random
+import time
+
+import pytest
+
+from benchmarks.fakecloud import FakeCloud
+from pyephember.pyephember import (
+    POINT_TYPE_LENGTHS, RateLimiter, Zone, ZoneChange, ZoneCommand,
+    ZoneMode, ZoneSchedule, decode_point_data, diff_zones,
+    encode_point_data, iter_point_data, point_data_to_values,
+    zone_commands_to_b64, zone_is_scheduled_on
+)
+
+
+def _random_records(rng, count):
+    """
+    count (index, point type, value) records with distinct indices
+    """
+    records = []
+    for index in rng.sample(range(300), count):
+        point_type = rng.choice(sorted(POINT_TYPE_LENGTHS))
+        value = rng.randrange(256 ** POINT_TYPE_LENGTHS[point_type])
+        records.append((index, point_type, value))
+    return records
+
+
+def test_point_data_round_trip():
+    rng = random.Random(11)
+    for _ in range(500):
+        records = _random_records(rng, rng.randint(0, 12))
+        raw = encode_point_data(records)
+        assert list(iter_point_data(raw)) == records
+        assert list(iter_point_data(bytearray(raw))) == records
+        assert decode_point_data(raw) == {
+            index: value for index, _, value in records
+        }
+        assert decode_point_data(memoryview(raw)) == decode_point_data(raw)
+
+
+def test_zone_commands_round_trip():
+    commands = [
+        ZoneCommand('TARGET_TEMP', 21.5),
+        ZoneCommand('MODE', ZoneMode.ALL_DAY.value),
+        ZoneCommand('BOOST_TIME', 1700000000),
+    ]
+    assert point_data_to_values(zone_commands_to_b64(commands)) == {
+        6: 215, 7: 1, 9: 1700000000
+    }
+
+
+@pytest.mark.parametrize('raw', [
+    b'\x00\x05',                    # no point type
+    b'\x00\x05\x04\x00',            # value cut short
+    b'\x00\x05\x63\x01',            # unknown point type
+    b'\x00\x04\x01\x00\x00',        # trailing byte
+])
+def test_decode_point_data_rejects_bad_data(raw):
+    with pytest.raises(ValueError):
+        decode_point_data(raw)
+
+
+def test_iter_point_data_is_lazy():
+    raw = encode_point_data([(4, 1, 1)]) + b'\x00\x05\x63'
+    records = iter_point_data(raw)
+    assert next(records) == (4, 1, 1)
+    with pytest.raises(ValueError):
+        next(records)
+
+
+def _scheduled_on_per_day(zone):
+    """
+    Reference: zone_is_scheduled_on as it was before ZoneSchedule,
+    evaluating the periods of the current day one by one
+    """
+    mode = ZoneMode(int(zone['pointDataList'][0]['value']))
+    if mode == ZoneMode.OFF:
+        return False
+    if mode == ZoneMode.ON:
+        return True
+
+    def to_time(stime):
+        return datetime.time(stime // 10, 10 * (stime % 10))
+
+    tstamp = time.gmtime(zone['timestamp'] / 1000)
+    ts_time = datetime.time(tstamp.tm_hour, tstamp.tm_min)
+    ts_wday = (tstamp.tm_wday + 1) % 7
+    for day in zone['deviceDays']:
+        if day['dayType'] != ts_wday:
+            continue
+        if mode == ZoneMode.AUTO:
+            periods = [day[period] for period in ('p1', 'p2', 'p3')]
+        else:
+            periods = [{'startTime': day['p1']['startTime'],
+                        'endTime': day['p3']['endTime']}]
+        for period in periods:
+            if (to_time(period['startTime']) <= ts_time
+                    <= to_time(period['endTime'])):
+                return True
+    return False
+
+
+def _random_zone(rng):
+    """
+    Zone dict with a random weekly program, mode and timestamp.
+    Periods may overlap, touch or end before they start.
+    """
+    def stime():
+        return rng.randint(0, 23) * 10 + rng.randint(0, 5)
+
+    device_days = [
+        {'dayType': day_type,
+         **{period: {'startTime': stime(), 'endTime': stime()}
+            for period in ('p1', 'p2', 'p3')}}
+        for day_type in range(7)
+    ]
+    return {
+        'mac': 'mac', 'name': 'Zone',
+        'deviceDays': device_days,
+        'timestamp': rng.randrange(2 ** 31) * 1000,
+        'pointDataList': [
+            {'pointIndex': 7, 'value': str(rng.randrange(4))}
+        ],
+    }
+
+
+def test_zone_schedule_matches_per_day_evaluation():
+    rng = random.Random(8)
+    for _ in range(3000):
+        zone = _random_zone(rng)
+        assert zone_is_scheduled_on(zone) == _scheduled_on_per_day(zone)
+        assert zone_is_scheduled_on(Zone(zone)) == \
+            _scheduled_on_per_day(zone)
+
+
+def test_zone_schedule_is_on_array():
+    numpy = pytest.importorskip('numpy')
+    rng = random.Random(9)
+    for _ in range(50):
+        zone = _random_zone(rng)
+        mode = ZoneMode(int(zone['pointDataList'][0]['value']))
+        if mode not in (ZoneMode.AUTO, ZoneMode.ALL_DAY):
+            continue
+        schedule = ZoneSchedule(zone['deviceDays'])
+        timestamps = numpy.array(
+            [rng.randrange(2 ** 31) for _ in range(200)]
+        )
+        expected = [schedule.is_on(stamp, mode) for stamp in timestamps]
+        assert list(schedule.is_on_array(timestamps, mode)) == expected
+
+
+def _zone(mac, name, points):
+    return {
+        'mac': mac, 'name': name,
+        'pointDataList': [
+            {'pointIndex': index, 'value': str(value)}
+            for index, value in points.items()
+        ],
+    }
+
+
+def test_diff_zones():
+    old = [
+        _zone('aa', 'Kitchen', {5: 200, 6: 210}),
+        _zone('bb', 'Hall', {5: 180}),
+        _zone('cc', 'Bedroom', {5: 190}),
+    ]
+    new = [
+        _zone('aa', 'Kitchen', {5: 205, 6: 210, 7: 1}),
+        _zone('bb', 'Hall', {5: 180}),
+        _zone('dd', 'Office', {5: 170}),
+    ]
+    assert sorted(diff_zones(old, new)) == sorted([
+        ZoneChange('aa', 'Kitchen', 5, 200, 205),
+        ZoneChange('aa', 'Kitchen', 7, None, 1),
+        ZoneChange('dd', 'Office', 5, None, 170),
+        ZoneChange('cc', 'Bedroom', 5, 190, None),
+    ])
+    assert not diff_zones(old, old)
+    assert diff_zones([Zone(zone) for zone in old], new) == \
+        diff_zones(old, new)
+
+
+@pytest.fixture
+def cloud():
+    with FakeCloud(zones=3) as fake:
+        yield fake
+
+
+def test_home_cache(cloud):
+    ember = cloud.client(cache_home=True, cache_ttl=60)
+    ember.get_zones()
+    ember.get_zone_names()
+    assert cloud.requests_to('homesVT/zoneProgram') == 1
+
+    ember.get_home(force=True)
+    assert cloud.requests_to('homesVT/zoneProgram') == 2
+
+    # a write drops the cached home, so the new value is read back
+    assert ember.set_zone_target_temperature('Zone 1', 23.5)
+    assert ember.get_zone_target_temperature('Zone 1') == 23.5
+    assert cloud.requests_to('homesVT/zoneProgram') == 3
+    ember.close()
+
+
+def test_home_cache_expires(cloud):
+    ember = cloud.client(cache_home=True, cache_ttl=0.2)
+    ember.get_zones()
+    ember.get_zones()
+    time.sleep(0.3)
+    ember.get_zones()
+    assert cloud.requests_to('homesVT/zoneProgram') == 2
+
+
+def test_rejected_token_is_renewed_once(cloud):
+    ember = cloud.client()
+    ember.list_homes()
+    cloud.fail('homes/list', 401)
+    assert ember.list_homes()
+    assert cloud.requests_to('appLogin/refreshAccessToken') == 1
+    assert cloud.requests_to('homes/list') == 3
+
+    # a rejected refresh token falls back to a full login
+    cloud.fail('homes/list', 401)
+    cloud.fail('appLogin/refreshAccessToken', 400)
+    assert ember.list_homes()
+    assert cloud.requests_to('appLogin/login') == 2
+
+
+def test_token_refresher(cloud):
+    ember = cloud.client()
+    with pytest.raises(ValueError):
+        ember.start_token_refresher(refresh_ahead=3600)
+    ember.list_homes()
+    # pylint: disable=protected-access
+    ember._login_data['last_refresh'] -= datetime.timedelta(seconds=1700)
+    ember.start_token_refresher(refresh_ahead=300)
+    try:
+        deadline = time.monotonic() + 5
+        while (cloud.requests_to('appLogin/refreshAccessToken') == 0
+               and time.monotonic() < deadline):
+            time.sleep(0.05)
+    finally:
+        ember.stop_token_refresher()
+    assert cloud.requests_to('appLogin/refreshAccessToken') == 1
+    assert ember._token_expires_in() > 1700
+
+
+def test_rate_limiter_adapts():
+    limiter = RateLimiter(16, backoff=0)
+    limiter.failure()
+    limiter.failure()
+    assert limiter.rate == 4
+    for _ in range(10):
+        limiter.failure()
+    assert limiter.rate == limiter.min_rate == 1
+    for _ in range(30):
+        limiter.success()
+    assert limiter.rate == 16
+    assert 0 < limiter.error_rate < 1
+
+
+def test_rate_limiter_retries_server_errors(cloud):
+    limiter = RateLimiter(50, backoff=0.01)
+    ember = cloud.client(rate_limiter=limiter)
+    ember.list_homes()
+    cloud.fail('homes/list', 503, times=2)
+    assert ember.list_homes()
+    assert cloud.requests_to('homes/list') == 4
+    assert limiter.rate < 50
+    assert limiter.error_rate > 0
+
+
+def test_zone_batch(cloud):
+    ember = cloud.client()
+    batch = ember.batch()
+    batch.set_target_temperature('Zone 0', 21)
+    batch.set_target_temperature('Zone 0', 22)
+    batch.set_mode('Zone 0', ZoneMode.ON)
+    batch.set_target_temperature('Zone 2', 18.5)
+    assert len(batch) == 2
+
+    published = cloud.stats()['mqtt_publishes']
+    assert batch.commit(wait=True, timeout=5) == {
+        'Zone 0': True, 'Zone 2': True
+    }
+    assert not batch
+    # one message per zone
+    assert cloud.stats()['mqtt_publishes'] - published == 2
+    assert ember.get_zone_target_temperature('Zone 0') == 22
+    assert ember.get_zone_mode('Zone 0') == ZoneMode.ON
+    assert ember.get_zone_target_temperature('Zone 2') == 18.5
+    ember.close()
+
+
+def test_session_cache(cloud, tmp_path):
+    path = str(tmp_path / 'session.json')
+    first = cloud.client(session_cache=path)
+    first.get_zones()
+    first.close()
+    requests = cloud.stats()['http_requests']
+
+    second = cloud.client(session_cache=path)
+    assert second.get_zone_names() == ['Zone 0', 'Zone 1', 'Zone 2']
+    # no login and no homes/list: only the zones were fetched
+    assert cloud.requests_to('appLogin/login') == 1
+    assert cloud.stats()['http_requests'] - requests == 1
+
+    # another user doesn't pick up the cached session
+    cloud.client('other@example.com', session_cache=path).get_zones()
+    assert cloud.requests_to('appLogin/login') == 2